@@ -325,13 +325,10 @@ class BioLayer:
         # for each state, iterate through the other states
         n = len(state_names)
         out = []
-        # Iterate through all possible states of n binary vars
+        # Iterate through all possible states of n binary vars; the value of state j is bit j of i, counting from the
+        # most significant of n bits.
         for i in range(1 << n):
-            s = bin(i)[2:]
-            s = '0' * (n - len(s)) + s
-            state = list(map(int, list(s)))
-            state_description = [(state_names[j], state[j]) for j in range(n)]
-            out.append(state_description)
+            out.append([(state_names[j], (i >> (n - 1 - j)) & 1) for j in range(n)])
         return out
 
     def convert_bio_sel_to_sys(self, sys, selector, compartment_override=None):
@@ -385,35 +382,17 @@ class BioLayer:
 
         Algorithm
         ---------
-        For each term in func.args:
-            * if it's a constant, leave it alone
-            * If it's a selector, convert it via :meth:`convert_bio_sel_to_sys` and substitute
-            * If it's an expr, recurse and substitute.
+        Convert each selector in func via :meth:`convert_bio_sel_to_sys`, and substitute them all at once with a single
+        ``xreplace``. Constants are left alone.
         """
 
-        for arg in func.args:
-            if isinstance(arg, Selector):
-                # term is a biolayer selector, convert to syslayer selector
-                sys_selector = None
-                if compartment_context is not None:
-                    sys_selector = self.convert_bio_sel_to_sys(sys, arg, compartment_override=compartment_context)
-                else:
-                    sys_selector = self.convert_bio_sel_to_sys(sys, arg)
-
-                func = func.subs(arg, sys_selector)
-            elif isinstance(arg, Constant):
-                # term is a constant, don't change it
-                sys_constant = arg
-                func = func.subs(arg, sys_constant)
+        mapping = {}
+        for arg in func.atoms(Selector):
+            if compartment_context is not None:
+                mapping[arg] = self.convert_bio_sel_to_sys(sys, arg, compartment_override=compartment_context)
             else:
-                # term is a composite, recurse
-                result = None
-                if compartment_context is not None:
-                    result = self.convert_bio_func_to_sys(sys, arg, compartment_context=compartment_context)
-                else:
-                    result = self.convert_bio_func_to_sys(sys, arg)
-                func = func.subs(arg, result)
-        return func
+                mapping[arg] = self.convert_bio_sel_to_sys(sys, arg)
+        return func.xreplace(mapping)
 
     # CORE
     def compose(self):
@@ -424,6 +403,10 @@ class BioLayer:
         sys.compartments = self.compartments
         sys.compartment_linkages = self.compartment_linkages
 
+        # Index the neighbours of each compartment once, rather than scanning the linkages for every species.
+        adjacent_compartments = {compartment: self.get_adjacent_compartments(compartment)
+                                 for compartment in self.compartments}
+
         # CREATE ALL THE ELEMENTS
         # Elements exist for each species for each compartment.
         # Create elements corresponding to the tx cells in each compartment
@@ -449,10 +432,13 @@ class BioLayer:
         # * cytokine modulation (intra-compartment, semi-autogen: target, secretion_state, action)
 
         for tx_cell in self.tx_cells:
+            # The states are the same in every compartment, so only generate them once.
+            states = self.gen_states_for_tx_cell(tx_cell)
+
             # migration - for each compartment, join each state to equiv in each adjacent compartment
             for compartment in self.compartments:
-                adjacent = self.get_adjacent_compartments(compartment)
-                for state in self.gen_states_for_tx_cell(tx_cell):
+                adjacent = adjacent_compartments[compartment]
+                for state in states:
                     a = sys.get_element_state('tx_cell', tx_cell['name'], compartment, state)
                     for adj_compartment in adjacent:
                         b = sys.get_element_state('tx_cell', tx_cell['name'], adj_compartment, state)
@@ -464,13 +450,13 @@ class BioLayer:
 
             # death - for each compartment, join each state to self with death coefficient
             for compartment in self.compartments:
-                for state in self.gen_states_for_tx_cell(tx_cell):
+                for state in states:
                     a = sys.get_element_state('tx_cell', tx_cell['name'], compartment, state)
                     sys.add_relationship('death', a, a, -Constant('k_death', 5)*a)
 
             # proliferation - for each compartment, join each state to daughter_state with birth coefficient
             for compartment in self.compartments:
-                for state in self.gen_states_for_tx_cell(tx_cell):
+                for state in states:
                     a = sys.get_element_state('tx_cell', tx_cell['name'], compartment, state)
                     b = sys.get_element_state('tx_cell', tx_cell['name'], compartment, tx_cell['daughter_state'])
                     if tx_cell['daughter_state'] == 'each':
@@ -491,17 +477,22 @@ class BioLayer:
 
             # state changes - for each compartment, join each state to relevant other states based on state_linkages
             for compartment in self.compartments:
-                for state in self.gen_states_for_tx_cell(tx_cell):
+                # Group the linkages by the element state they stem from, so each state finds its own with one lookup
+                # instead of converting and comparing every linkage. Selector names identify element states.
+                linkages_from = {}
+                for linkage in tx_cell['state_linkages']:
+                    link_a_sys = self.convert_bio_sel_to_sys(sys, linkage['a'], compartment_override=compartment)
+                    linkages_from.setdefault(link_a_sys.name, []).append(linkage)
+
+                for state in states:
                     a = sys.get_element_state('tx_cell', tx_cell['name'], compartment, state)
-                    for linkage in tx_cell['state_linkages']:
-                        # if the linkage stems from a, add the linkage
-                        link_a_sys = self.convert_bio_sel_to_sys(sys, linkage['a'], compartment_override=compartment)
-                        if a.selector == link_a_sys.selector:
-                            # The func will be in terms of elements in the local compartment.
-                            # It is possible that a term will be undefined in the local compartment (e.g. a+b+ cells)
-                            b = self.convert_bio_sel_to_sys(sys, linkage['b'], compartment_override=compartment)
-                            func = self.convert_bio_func_to_sys(sys, linkage['func'], compartment_context=compartment)
-                            sys.add_relationship('state_link', a, b, func)
+                    # if the linkage stems from a, add the linkage
+                    for linkage in linkages_from.get(a.name, []):
+                        # The func will be in terms of elements in the local compartment.
+                        # It is possible that a term will be undefined in the local compartment (e.g. a+b+ cells)
+                        b = self.convert_bio_sel_to_sys(sys, linkage['b'], compartment_override=compartment)
+                        func = self.convert_bio_func_to_sys(sys, linkage['func'], compartment_context=compartment)
+                        sys.add_relationship('state_link', a, b, func)
 
             # killing - for each compartment, join the killer state to the killed state for the tx cell
             for compartment in self.compartments:
@@ -557,7 +548,7 @@ class BioLayer:
             # for each compartment, add migration linkage to adjacent compartments
             for compartment in self.compartments:
                 a = sys.get_element('cytokine', cytokine['name'], compartment)
-                for adj in self.get_adjacent_compartments(compartment):
+                for adj in adjacent_compartments[compartment]:
                     b = sys.get_element('cytokine', cytokine['name'], adj)
                     func = a*Constant('k_diffuse', 10)
                     sys.add_relationship('diffusion', a, b, func)
@@ -86,12 +86,17 @@ class Constant(sy.Symbol):
 
 
 def ravel_expression(expr):
+    # Walk the tree with an explicit stack (in preorder) rather than recursing and concatenating lists, which is
+    # quadratic in the size of the expression.
     args = []
-    for arg in expr.args:
-        if isinstance(arg, Selector) or isinstance(arg, Constant):
-            args.append(arg)
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Selector) or isinstance(node, Constant):
+            args.append(node)
         else:
-            args = args + ravel_expression(arg)
+            # Reversed, so that the first arg is popped (and so visited) first.
+            stack.extend(reversed(node.args))
     return args
 
 def hill(x, kmin, kmax, x50, n):
@@ -36,6 +36,11 @@ class GraphLayer():
 		n['state'] = state
 		self.nodes.append(n)
 
+	def add_nodes(self, records):
+		# Add many nodes at once from (type, name, compartment, state) tuples, with state None for stateless nodes.
+		self.nodes.extend({'type': type, 'name': name, 'compartment': compartment, 'state': state}
+						  for type, name, compartment, state in records)
+
 	def add_edge(self, type, a, b, func):
 		e = {}
 		e['type'] = type
@@ -101,36 +106,21 @@ class GraphLayer():
 			cmd = 'dot -Tpng -Gdpi=400 graph.dot > graph.png; open graph.png'
 			subprocess.run(cmd, shell=True)
 
+	# The helpers below read the node's own adjacency, so they take O(degree) rather than scanning every edge of the
+	# graph; compose_ode_system calls them once per node.
+
 	def selfloops_for_node(self, graph, node):
-		sl = nx.selfloop_edges(graph, data=True)
-		out = []
-		for l in sl:
-			if l[0] is node:
-				out.append(l)
-		return out
+		return [edge for edge in graph.out_edges(node, data=True) if edge[1] == node]
 
 	def in_edges_for_node(self, graph, node):
-		edges = graph.edges(data=True)
-		out = []
-
-		for edge in edges:
-			if edge[1] is node:
-				out.append(edge)
-		return out
+		return list(graph.in_edges(node, data=True))
 
 	def out_edges_for_node(self, graph, node):
-		edges = graph.edges(data=True)
-		out = []
-
-		for edge in edges:
-			if edge[0] is node:
-				out.append(edge)
-		return out
+		return list(graph.out_edges(node, data=True))
 
 	def compose_ode_system(self):
 		G = self.generate_graph()
 
-		funcs = nx.get_edge_attributes(G, 'func')
 		node_sels = nx.get_node_attributes(G, 'data')
 
 		equations = []
@@ -142,7 +132,8 @@ class GraphLayer():
 			except:
 				warn('failed to get node selector for node %s' % node)
 				continue
-			node_equation = sy.sympify(0)
+			# Collect the terms and add them up once at the end; adding them one by one rebuilds the sum every time.
+			terms = []
 			# print("------------")
 			# print("Addressing Node: %s" % node)
 			# print("This node has %i in-edges" % len(G.in_edges(node)))
@@ -150,49 +141,50 @@ class GraphLayer():
 
 			# For edge pointing to the node, add the edge functions to the equation
 			for edge in self.in_edges_for_node(G, node):
-				node_equation = node_equation + edge[2]['func']
+				terms.append(edge[2]['func'])
 				# print("Added Term (IN): %s" % edge[2]['func'])
 
 			# For each edge originating from the node, subtract edge functions if destination node is same type and name
+			# The out-edges all originate from this node, so only the destination needs to be looked up.
+			origin = node_selector.selector
 			for edge in self.out_edges_for_node(G, node):
+				func = edge[2]['func']
 				try:
-					if edge[2]['func'].args[0].name == 'k_proliferation' or edge[2]['func'].args[0].name == 'tx_activ_prolif' \
-							or edge[2]['func'].args[0].name == 'k_activ_prolif':
+					if func.args[0].name == 'k_proliferation' or func.args[0].name == 'tx_activ_prolif' \
+							or func.args[0].name == 'k_activ_prolif':
 						warn("WARNING: Celltx GraphLayer used extremely hacked up protection clause to not subtract proliferation")
 						continue
 				except:
 					pass
 				try:
-					origin_node = node_sels[edge[0]]
-					destination_node = node_sels[edge[1]]
-
+					destination = node_sels[edge[1]].selector
+				except KeyError:
+					continue
+				try:
 					# If it's a state change (same type, name, compartment), subtract the term.
-					if origin_node.selector['target_type'] == destination_node.selector['target_type'] and \
-						origin_node.selector['target_name'] == destination_node.selector['target_name'] and \
-						origin_node.selector['target_compartment'] == destination_node.selector['target_compartment']:
+					if origin['target_type'] == destination['target_type'] and \
+						origin['target_name'] == destination['target_name'] and \
+						origin['target_compartment'] == destination['target_compartment']:
 
-						if destination_node.selector != origin_node.selector:
+						if destination != origin:
 
-							node_equation = node_equation - edge[2]['func']
-							# print("Added Term (OUT, statechange rule): %s" % edge[2]['func'])
+							terms.append(-func)
+							# print("Added Term (OUT, statechange rule): %s" % func)
 				except:
 					pass
 				try:
-					origin_node = node_sels[edge[0]]
-					destination_node = node_sels[edge[1]]
-
-
 					# If it's migration (same type, name, state, different compartments), subtract the term.
-					if origin_node.selector['target_type'] == destination_node.selector['target_type'] and \
-							origin_node.selector['target_name'] == destination_node.selector['target_name'] and \
-							origin_node.selector['state'] == destination_node.selector['state'] and \
-							origin_node.selector['target_compartment'] != destination_node.selector['target_compartment']:
-						if destination_node.selector != origin_node.selector:
-							node_equation = node_equation - edge[2]['func']
-							# print("Added Term (OUT, migration rule): %s" % edge[2]['func'])
+					if origin['target_type'] == destination['target_type'] and \
+							origin['target_name'] == destination['target_name'] and \
+							origin['state'] == destination['state'] and \
+							origin['target_compartment'] != destination['target_compartment']:
+						if destination != origin:
+							terms.append(-func)
+							# print("Added Term (OUT, migration rule): %s" % func)
 				except:
 					pass
 
+			node_equation = sy.Add(*terms)
 			equation = sy.Eq(sy.Derivative(node_selector, sy.sympify('t')), node_equation)
 
 			equations.append(equation)
@@ -0,0 +1,252 @@
+# Copyright 2020 Hersh K. Bhargava (https://hershbhargava.com)
+# Laboratories of Hana El-Samad and Wendell A. Lim
+# University of California, San Francisco
+
+"""
+Integrators compiled with numba, for use with the njit'd right hand side `f_rhs(X, t, args)` generated by
+`ODELayer.gen_rhs`. Since the whole integration runs in compiled code, there is no Python callback per step as with
+`scipy.integrate.odeint`, and ensembles of simulations can be spread over threads with `numba.prange`.
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit
+def rk4(f_rhs, x0, t, args, n_substeps):
+    """
+    Integrate `f_rhs` from `x0` with the classic fixed step 4th order Runge-Kutta method.
+
+    Parameters
+    ----------
+    f_rhs : numba dispatcher
+        Compiled right hand side f_rhs(X, t, args).
+    x0 : np.ndarray
+        Initial value of each species.
+    t : np.ndarray
+        Timepoints at which to report the state of the model. The integration starts at t[0].
+    args : np.ndarray
+        Value of each parameter.
+    n_substeps : int
+        Number of steps to take between consecutive timepoints in `t`.
+
+    Returns
+    -------
+    np.ndarray with a row for each timepoint (in `t`) and a column for each species.
+    """
+    out = np.empty((t.shape[0], x0.shape[0]))
+    X = x0.copy()
+    out[0, :] = X
+
+    for i in range(1, t.shape[0]):
+        h = (t[i] - t[i - 1]) / n_substeps
+        _t = t[i - 1]
+        for _ in range(n_substeps):
+            k1 = f_rhs(X, _t, args)
+            k2 = f_rhs(X + 0.5 * h * k1, _t + 0.5 * h, args)
+            k3 = f_rhs(X + 0.5 * h * k2, _t + 0.5 * h, args)
+            k4 = f_rhs(X + h * k3, _t + h, args)
+            X = X + (h / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+            _t += h
+        out[i, :] = X
+
+    return out
+
+
+@njit(parallel=True)
+def rk4_ensemble(f_rhs, x0s, t, args_sets, n_substeps):
+    """
+    Integrate `f_rhs` once for each row of `x0s` and `args_sets` with `rk4`, in parallel over numba's threads.
+
+    Parameters
+    ----------
+    f_rhs : numba dispatcher
+        Compiled right hand side f_rhs(X, t, args).
+    x0s : np.ndarray
+        Array with a row of initial values for each simulation.
+    t : np.ndarray
+        Timepoints at which to report the state of the model.
+    args_sets : np.ndarray
+        Array with a row of parameter values for each simulation.
+    n_substeps : int
+        Number of steps to take between consecutive timepoints in `t`.
+
+    Returns
+    -------
+    np.ndarray of shape (simulations, timepoints, species).
+    """
+    out = np.empty((x0s.shape[0], t.shape[0], x0s.shape[1]))
+    for i in prange(x0s.shape[0]):
+        out[i] = rk4(f_rhs, x0s[i], t, args_sets[i], n_substeps)
+    return out
+
+
+# Dormand-Prince 5(4) tableau.
+_A21 = 1.0 / 5.0
+_A31, _A32 = 3.0 / 40.0, 9.0 / 40.0
+_A41, _A42, _A43 = 44.0 / 45.0, -56.0 / 15.0, 32.0 / 9.0
+_A51, _A52, _A53, _A54 = 19372.0 / 6561.0, -25360.0 / 2187.0, 64448.0 / 6561.0, -212.0 / 729.0
+_A61, _A62, _A63, _A64, _A65 = 9017.0 / 3168.0, -355.0 / 33.0, 46732.0 / 5247.0, 49.0 / 176.0, -5103.0 / 18656.0
+_B1, _B3, _B4, _B5, _B6 = 35.0 / 384.0, 500.0 / 1113.0, 125.0 / 192.0, -2187.0 / 6784.0, 11.0 / 84.0
+# Difference between the 5th and 4th order weights, which gives the local error estimate.
+_E1, _E3, _E4, _E5, _E6, _E7 = (71.0 / 57600.0, -71.0 / 16695.0, 71.0 / 1920.0, -17253.0 / 339200.0, 22.0 / 525.0,
+                                -1.0 / 40.0)
+
+
+@njit
+def _error_norm(err, X, X_new, rtol, atol):
+    total = 0.0
+    for i in range(err.shape[0]):
+        scale = atol + rtol * max(abs(X[i]), abs(X_new[i]))
+        total += (err[i] / scale) ** 2
+    return np.sqrt(total / err.shape[0])
+
+
+@njit
+def _initial_step(f_rhs, X, t0, args, f0, rtol, atol, direction):
+    # Hairer, Norsett & Wanner, Solving Ordinary Differential Equations I, section II.4.
+    scale = atol + rtol * np.abs(X)
+    d0 = np.sqrt(np.mean((X / scale) ** 2))
+    d1 = np.sqrt(np.mean((f0 / scale) ** 2))
+    h0 = 0.01 * d0 / d1 if d0 > 1e-5 and d1 > 1e-5 else 1e-6
+    f1 = f_rhs(X + direction * h0 * f0, t0 + direction * h0, args)
+    d2 = np.sqrt(np.mean(((f1 - f0) / scale) ** 2)) / h0
+    if max(d1, d2) <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** 0.2
+    return min(100.0 * h0, h1)
+
+
+@njit
+def dopri5(f_rhs, x0, t, args, rtol, atol, max_steps):
+    """
+    Integrate `f_rhs` from `x0` with the adaptive Dormand-Prince 5(4) method. Steps are shortened where needed to land
+    on each timepoint in `t` exactly. Like odeint, it integrates backwards in time if `t` is decreasing.
+
+    Explicit methods crawl along at tiny steps on stiff problems, so it gives up as soon as the problem looks stiff,
+    using the test of Hairer's DOPRI5: the step size times an estimate of the dominant eigenvalue of the Jacobian is
+    beyond the stability region on 15 accepted steps without 6 non-stiff steps in a row in between.
+
+    Parameters
+    ----------
+    f_rhs : numba dispatcher
+        Compiled right hand side f_rhs(X, t, args).
+    x0 : np.ndarray
+        Initial value of each species.
+    t : np.ndarray
+        Timepoints at which to report the state of the model. The integration starts at t[0]. Must be monotonic.
+    args : np.ndarray
+        Value of each parameter.
+    rtol, atol : float
+        Relative and absolute tolerance of the local error of each step.
+    max_steps : int
+        Number of steps (accepted or rejected) after which to give up.
+
+    Returns
+    -------
+    tuple[np.ndarray, bool]
+        Array with a row for each timepoint (in `t`) and a column for each species, and whether the integration
+        reached the end of `t`. If it didn't (because the model is stiff, `max_steps` was reached, or `t` isn't
+        monotonic), rows after the failure are NaN.
+    """
+    out = np.full((t.shape[0], x0.shape[0]), np.nan)
+    X = x0.copy()
+    out[0, :] = X
+    if t.shape[0] < 2:
+        return out, True
+
+    # Step sizes h are positive; each step moves the time by direction * h.
+    direction = 1.0 if t[-1] >= t[0] else -1.0
+    for i in range(1, t.shape[0]):
+        if direction * (t[i] - t[i - 1]) < 0:
+            return out, False
+
+    _t = t[0]
+    k1 = f_rhs(X, _t, args)
+    h = _initial_step(f_rhs, X, _t, args, k1, rtol, atol, direction)
+    steps = 0
+    stiff_steps = 0
+    nonstiff_steps = 0
+
+    for i in range(1, t.shape[0]):
+        while direction * (t[i] - _t) > 0:
+            if steps >= max_steps or h < 1e-14 * max(abs(_t), 1.0):
+                return out, False
+            steps += 1
+
+            step_to_output = h >= direction * (t[i] - _t)
+            if step_to_output:
+                h = direction * (t[i] - _t)
+            dt = direction * h
+
+            k2 = f_rhs(X + dt * (_A21 * k1), _t + dt / 5.0, args)
+            k3 = f_rhs(X + dt * (_A31 * k1 + _A32 * k2), _t + 3.0 * dt / 10.0, args)
+            k4 = f_rhs(X + dt * (_A41 * k1 + _A42 * k2 + _A43 * k3), _t + 4.0 * dt / 5.0, args)
+            k5 = f_rhs(X + dt * (_A51 * k1 + _A52 * k2 + _A53 * k3 + _A54 * k4), _t + 8.0 * dt / 9.0, args)
+            X6 = X + dt * (_A61 * k1 + _A62 * k2 + _A63 * k3 + _A64 * k4 + _A65 * k5)
+            k6 = f_rhs(X6, _t + dt, args)
+            X_new = X + dt * (_B1 * k1 + _B3 * k3 + _B4 * k4 + _B5 * k5 + _B6 * k6)
+            k7 = f_rhs(X_new, _t + dt, args)
+
+            err = dt * (_E1 * k1 + _E3 * k3 + _E4 * k4 + _E5 * k5 + _E6 * k6 + _E7 * k7)
+            err_norm = _error_norm(err, X, X_new, rtol, atol)
+
+            if err_norm <= 1.0:
+                # Stiffness detection: k7 and k6 are evaluated at the same time, so h * |k7 - k6| / |X_new - X6|
+                # estimates h times the dominant eigenvalue of the Jacobian.
+                den = np.sum((X_new - X6) ** 2)
+                if den > 0.0 and h * np.sqrt(np.sum((k7 - k6) ** 2) / den) > 3.25:
+                    nonstiff_steps = 0
+                    stiff_steps += 1
+                    if stiff_steps == 15:
+                        return out, False
+                else:
+                    nonstiff_steps += 1
+                    if nonstiff_steps == 6:
+                        stiff_steps = 0
+
+                # Accept the step. k7 is the derivative at the new point, so it is the next step's k1.
+                _t = t[i] if step_to_output else _t + dt
+                X = X_new
+                k1 = k7
+                factor = 10.0 if err_norm == 0.0 else min(10.0, 0.9 * err_norm ** -0.2)
+            else:
+                factor = max(0.2, 0.9 * err_norm ** -0.2)
+            h = h * factor
+
+        out[i, :] = X
+
+    return out, True
+
+
+@njit(parallel=True)
+def dopri5_ensemble(f_rhs, x0s, t, args_sets, rtol, atol, max_steps):
+    """
+    Integrate `f_rhs` once for each row of `x0s` and `args_sets` with `dopri5`, in parallel over numba's threads.
+
+    Parameters
+    ----------
+    f_rhs : numba dispatcher
+        Compiled right hand side f_rhs(X, t, args).
+    x0s : np.ndarray
+        Array with a row of initial values for each simulation.
+    t : np.ndarray
+        Timepoints at which to report the state of the model.
+    args_sets : np.ndarray
+        Array with a row of parameter values for each simulation.
+    rtol, atol : float
+        Relative and absolute tolerance of the local error of each step.
+    max_steps : int
+        Number of steps after which to give up on a simulation.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Array of shape (simulations, timepoints, species), and whether each simulation reached the end of `t`.
+    """
+    out = np.empty((x0s.shape[0], t.shape[0], x0s.shape[1]))
+    success = np.empty(x0s.shape[0], dtype=np.bool_)
+    for i in prange(x0s.shape[0]):
+        out[i], success[i] = dopri5(f_rhs, x0s[i], t, args_sets[i], rtol, atol, max_steps)
+    return out, success
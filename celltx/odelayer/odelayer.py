@@ -3,40 +3,103 @@
 # University of California, San Francisco
 
 import numpy as np
+import numba
 from numba import njit
 import sympy as sy
 from sympy.utilities.lambdify import lambdastr
-from scipy.integrate import odeint
-from smt.sampling_methods import LHS
+from scipy.integrate import odeint, solve_ivp
+from scipy.stats import qmc
 from tqdm import tqdm
-import math, time
+import time
 import sys
+import os
+import hashlib
+import re
+import inspect
+import importlib.util
+import types
 import multiprocessing as mp
 from warnings import warn
 import copy
 
-from ..functions import Selector, Constant
+from .integrator import rk4, rk4_ensemble, dopri5, dopri5_ensemble
+from ..functions import Selector, Constant, ravel_expression
 from ..util import format_timedelta
 
+# Backends of `ODELayer.solve` that `ODELayer.solve_ensemble` can integrate many simulations at once with.
+ENSEMBLE_BACKENDS = ('odeint', 'rk4', 'dopri5')
+
+# Directory for generated model modules and numba's cache of their compiled functions. Set the CELLTX_CACHE_DIR
+# environment variable to move it, e.g. when the home directory is read-only.
+CACHE_DIR = os.environ.get('CELLTX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.celltx', 'cache'))
+
+# numba signature of f_rhs(X, t, args) and f_jac(X, t, args) (see `ODELayer.gen_rhs`), for the contiguous float64
+# arrays that odeint and the integrators pass to them.
+_RHS_SIGNATURE = (numba.float64[::1], numba.float64, numba.float64[::1])
+# numba signature of f_rhs_stacked(Y, t, args_sets) and f_jac_stacked(Y, t, args_sets) (see `ODELayer.gen_stacked`).
+_STACKED_SIGNATURE = (numba.float64[::1], numba.float64, numba.float64[:, ::1])
+
+# Hash of this file, so that cached model modules are regenerated when the code that generates them changes.
+with open(__file__, 'rb') as _f:
+    _CODEGEN_HASH = hashlib.sha1(_f.read()).hexdigest()
+
 
 class ODELayer():
 
     def __init__(self, equations):
         self.equations = equations
         self.f_model = None
+        self.f_rhs = None
+        self.f_jac = None
+        self.f_rhs_stacked = None
+        self.f_jac_stacked = None
         self.species = None
         self.params = None
-        self.lambda_string = None
+        self._species_idx = None
+        self._param_idx = None
+        self._lambda_string = None
         self.unique_args = None
         self.ordered_rhss = None
         self.x0 = None
+        self._param_values = None
+        self._param_lo = None
+        self._param_hi = None
         self.param_search_ranges = {}
         self.x0_search_ranges = {}
         self.pinned_params = []
+        # Integrator used by `self.solve` (and so by all simulations): 'odeint', 'solve_ivp', 'rk4' or 'dopri5'.
+        self.backend = 'odeint'
+        # Number of fixed steps the 'rk4' backend takes between consecutive timepoints.
+        self.rk4_substeps = 10
+        # Tolerances of the 'odeint', 'solve_ivp' and 'dopri5' backends (the defaults are odeint's), the number of steps
+        # odeint may take between two timepoints before giving up (odeint's default is 500), and the number of steps
+        # after which 'dopri5' gives up and falls back to odeint (it also gives up early on models it detects as stiff).
+        self.rtol = 1.49012e-8
+        self.atol = 1.49012e-8
+        self.odeint_mxstep = 5000
+        self.dopri5_max_steps = 100000
+        # Number of simulations the 'odeint' backend stacks into each odeint call in `self.solve_ensemble`. The stacked
+        # simulations share their steps, so when they are stiff and very different, smaller batches are faster; 1
+        # integrates them one at a time.
+        self.odeint_batch_size = 16
+
+    @property
+    def lambda_string(self):
+        """
+        Source of the lambda behind `self.f_model`. Generated on first access, since it is only needed for inspection.
+
+        Returns
+        -------
+        str or None
+        """
+        if self._lambda_string is None and self.unique_args is not None:
+            self._lambda_string = lambdastr(self.unique_args, self.ordered_rhss, dummify=True)
+        return self._lambda_string
 
     def ravel_expression(self, expr):
         """
-        Given a Sympy expression, return an array of all arguments (selectors and constant) in the expression.
+        Given a Sympy expression, return an array of all arguments (selectors and constant) in the expression, in
+        preorder (see `celltx.functions.ravel_expression`).
 
         Parameters
         ----------
@@ -47,14 +110,27 @@ class ODELayer():
         -------
         list[Selector or Constant]
         """
+        return ravel_expression(expr)
 
-        args = []
-        for arg in expr.args:
-            if isinstance(arg, Selector) or isinstance(arg, Constant):
-                args.append(arg)
-            else:
-                args = args + self.ravel_expression(arg)
-        return args
+    def fold_numbers(self, expr):
+        """
+        Replace every purely numeric subexpression of `expr` that is not already a rational or a float (e.g. exp(2),
+        sqrt(2) or pi) with its floating point value. Rationals are left alone, so terms like 1/k keep their form.
+
+        Parameters
+        ----------
+        expr : Sympy.core.expr.Expr
+            Expression to fold.
+
+        Returns
+        -------
+        Sympy.core.expr.Expr
+        """
+        numbers = {}
+        for sub in sy.preorder_traversal(expr):
+            if sub.is_number and not sub.is_Rational and not sub.is_Float:
+                numbers[sub] = sub.evalf()
+        return expr.xreplace(numbers)
 
     def gen_ode_model(self):
         """
@@ -66,12 +142,13 @@ class ODELayer():
         None
         """
         # Prune any term from an equation that is not either a constant or the LHS of another equation.
+        # All of an equation's pruned terms are replaced in one pass, rather than rebuilding the tree for each one.
         pruned_eqs = []
-        lhs = [eq.lhs.args[0] for eq in self.equations]
+        lhs = set(eq.lhs.args[0] for eq in self.equations)
         for eq in self.equations:
-            for arg in self.ravel_expression(eq.rhs):
-                if arg not in lhs and not isinstance(arg, Constant):
-                    eq = eq.subs(arg, 0)
+            prune = {arg: sy.S.Zero for arg in eq.rhs.atoms(Selector) if arg not in lhs}
+            if prune:
+                eq = sy.Eq(eq.lhs, eq.rhs.xreplace(prune))
             pruned_eqs.append(eq)
         self.equations = pruned_eqs
 
@@ -80,30 +157,31 @@ class ODELayer():
 
         all_args = []
         for eq in rhss:
-            args = self.ravel_expression(eq)
-            for a in args:
-                all_args.append(a)
+            all_args.extend(self.ravel_expression(eq))
 
         # remove duplicates
         unique_sels = []
         unique_consts = []
-        seen_sel = []
-        seen_const = []
+        seen_sel = set()
+        seen_const = set()
 
         for val in all_args:
             if isinstance(val, Selector):
-                if val.selector not in seen_sel:
-                    seen_sel.append(val.selector)
+                if val.name not in seen_sel:
+                    seen_sel.add(val.name)
                     unique_sels.append(val)
             elif isinstance(val, Constant):
                 if val.name not in seen_const:
-                    seen_const.append(val.name)
+                    seen_const.add(val.name)
                     unique_consts.append(val)
             else:
                 print('unable to handle %s' % val)
 
         self.species = unique_sels
         self.params = unique_consts
+        # Map names to indices so that lookups by name don't scan the lists.
+        self._species_idx = {species.name: i for i, species in enumerate(self.species)}
+        self._param_idx = {param.name: i for i, param in enumerate(self.params)}
 
         # We need the rhss in the same order as the same order as the unique_sels to pass to lambdify.
         ordered_rhss = []
@@ -111,29 +189,341 @@ class ODELayer():
         # In the process, we will rearrange self.equations to be in the same order.
         ordered_equations = []
 
+        # Index the equations by the name of their species, rather than scanning them for every species.
+        eq_by_species = {}
+        for eq in self.equations:
+            eq_by_species.setdefault(eq.lhs.args[0].name, []).append(eq)
+
         for arg in unique_sels:
-            for eq in self.equations:
-                if eq.lhs.args[0].selector == arg.selector:
-                    ordered_rhss.append(eq.rhs)
-                    ordered_equations.append(eq)
+            for eq in eq_by_species.get(arg.name, []):
+                ordered_rhss.append(eq.rhs)
+                ordered_equations.append(eq)
 
         self.equations = ordered_equations
 
         unique_args = unique_sels + unique_consts
         self.unique_args = unique_args
+        # Fold symbolic numbers (e.g. exp(2) or pi) to floats so they are literals in the compiled code.
+        ordered_rhss = [self.fold_numbers(rhs) for rhs in ordered_rhss]
+
         self.ordered_rhss = ordered_rhss
-        self.f_model = sy.lambdify(unique_args, ordered_rhss)
-        self.f_model = njit(self.f_model)
+        model_module = self.load_model()
+        self.f_model = model_module.f_model
+        self.f_rhs = model_module.f_rhs
+        self.f_rhs_stacked = model_module.f_rhs_stacked
+        # None when the Jacobian couldn't be compiled (see `self.gen_model_source`); the integrators then estimate it.
+        self.f_jac = getattr(model_module, 'f_jac', None)
+        self.f_jac_stacked = getattr(model_module, 'f_jac_stacked', None)
         print("celltx ODELayer: Successfully compiled self.f_model to C via njit.")
-        self.lambda_string = lambdastr(unique_args, ordered_rhss, dummify=True)
+        self._lambda_string = None
 
         # Also generate starting conditions self.x0 (zeros for each species)
         self.x0 = np.zeros(len(self.species))
 
+        # Cache the numeric parameter values so that integration doesn't need to convert Sympy expressions.
+        # Kept up to date by self.set_param_value.
+        self._param_values = np.array([float(param.expr) for param in self.params], dtype=np.float64)
+
+        # Lower and upper sampling bound of each parameter, in the order of self.params. Parameters without a search
+        # range are held at their value. Kept up to date by self.set_param_value and self.set_param_search_range.
+        self._param_lo = self._param_values.copy()
+        self._param_hi = self._param_values.copy()
+        for name, rnge in self.param_search_ranges.items():
+            if name not in self._param_idx:
+                warn('celltx ODELayer could not find param with name %s; ignoring its search range' % name)
+                continue
+            self._param_lo[self._param_idx[name]], self._param_hi[self._param_idx[name]] = rnge
+
+        # numba would compile (or load from its cache) on the first call, so compile for the types the integrators
+        # pass here instead. Processes forked for a parallel search then inherit the compiled functions, rather than
+        # each of them compiling on its own. Compiling from the signature doesn't evaluate the model, which may not be
+        # defined at any particular state (e.g. hill divides by its species). The stacked functions are only needed by
+        # searches, so they are left to `self.solve_ensemble`.
+        self.f_rhs.compile(_RHS_SIGNATURE)
+        if self.f_jac is not None:
+            try:
+                self.f_jac.compile(_RHS_SIGNATURE)
+            except Exception as e:
+                warn('celltx ODELayer: Unable to compile the Jacobian of the model (%s); the integrators will estimate '
+                     'it instead.' % e)
+                self.f_jac = None
+                self.f_jac_stacked = None
+
+    def gen_rhs(self):
+        """
+        Generate the source of a function f_rhs(X, t, args) that evaluates `f_model` directly from the array of species
+        values and the array of parameter values. Indexing the arrays happens in compiled code, so there is no
+        concatenation or unpacking of the arguments in Python on each evaluation.
+
+        f_rhs also applies the non-negativity rule of `self.model`: if the current value of a species is <= 0, its
+        derivative is not allowed to be negative. The derivatives are written straight from the tuple returned by
+        `f_model` into the output array, so no intermediate list or array is built.
+
+        Returns
+        -------
+        str
+        """
+        n = len(self.species)
+        in_vals = ['X[%i]' % i for i in range(n)] + ['args[%i]' % i for i in range(len(self.params))]
+        lines = ['def f_rhs(X, t, args):',
+                 '    dX = f_model(%s)' % ', '.join(in_vals),
+                 '    out = np.empty(%i)' % n]
+        for i in range(n):
+            lines.append('    out[%i] = 0.0 if X[%i] <= 0 and dX[%i] < 0 else dX[%i]' % (i, i, i, i))
+        lines.append('    return out')
+        return '\n'.join(lines) + '\n'
+
+    def gen_jac(self, nonzero):
+        """
+        Generate the source of a function f_jac(X, t, args) which evaluates `f_jac_model` (see `self.gen_model_source`)
+        and returns the Jacobian of the system as an (n_species, n_species) array, where element [i, j] is the
+        derivative of equation i with respect to species j. It is passed to odeint as `Dfun` so that LSODA doesn't need
+        to estimate the Jacobian with finite differences.
+
+        Most entries of the Jacobian are structurally zero, so `f_jac_model` only returns the others, and f_jac writes
+        them into a zeroed array.
+
+        Parameters
+        ----------
+        nonzero : list[tuple[int, int]]
+            Position in the Jacobian of each value returned by `f_jac_model`.
+
+        Returns
+        -------
+        str
+        """
+        n = len(self.species)
+        in_vals = ['X[%i]' % i for i in range(n)] + ['args[%i]' % i for i in range(len(self.params))]
+        lines = ['def f_jac(X, t, args):',
+                 '    out = np.zeros((%i, %i))' % (n, n)]
+        if len(nonzero) > 0:
+            lines.append('    J = f_jac_model(%s)' % ', '.join(in_vals))
+        for k, (i, j) in enumerate(nonzero):
+            lines.append('    out[%i, %i] = J[%i]' % (i, j, k))
+        lines.append('    return out')
+        return '\n'.join(lines) + '\n'
+
+    def gen_stacked(self, jacobian=True):
+        """
+        Generate the source of functions f_rhs_stacked(Y, t, args_sets) and f_jac_stacked(Y, t, args_sets), the right
+        hand side and Jacobian of a batch of independent simulations stacked into one system, so that they can be
+        integrated together by a single odeint call (see `self.solve_stacked`). Simulation b occupies
+        Y[b * n:(b + 1) * n], where n is the number of species, and uses the parameter values in args_sets[b].
+
+        The simulations are independent, so the Jacobian is block diagonal, with the Jacobian of each simulation (see
+        `self.gen_jac`) as a block. f_jac_stacked returns it in the banded format odeint expects with
+        ml = mu = n - 1: element [i - j + n - 1, j] is the derivative of equation i with respect to state j. LSODA then
+        factorizes it as a band matrix, at a cost that grows linearly rather than cubically with the batch size.
+
+        Parameters
+        ----------
+        jacobian : bool
+            Whether to generate f_jac_stacked, which calls f_jac.
+
+        Returns
+        -------
+        str
+        """
+        n = len(self.species)
+        lines = ['def f_rhs_stacked(Y, t, args_sets):',
+                 '    out = np.empty(Y.shape[0])',
+                 '    for b in range(args_sets.shape[0]):',
+                 '        out[b * %i:(b + 1) * %i] = f_rhs(Y[b * %i:(b + 1) * %i], t, args_sets[b])' % (n, n, n, n),
+                 '    return out']
+        if jacobian:
+            lines += ['',
+                      '',
+                      'def f_jac_stacked(Y, t, args_sets):',
+                      '    out = np.zeros((%i, Y.shape[0]))' % (2 * n - 1),
+                      '    for b in range(args_sets.shape[0]):',
+                      '        J = f_jac(Y[b * %i:(b + 1) * %i], t, args_sets[b])' % (n, n),
+                      '        for i in range(%i):' % n,
+                      '            for j in range(%i):' % n,
+                      '                out[i - j + %i, b * %i + j] = J[i, j]' % (n - 1, n),
+                      '    return out']
+        return '\n'.join(lines) + '\n'
+
+    def gen_model_source(self, arg_symbols, rhss):
+        """
+        Generate the source of a Python module defining the numerical functions of the model:
+            * ``f_model(*species, *params)`` : tuple of `rhss`, lambdified.
+            * ``f_jac_model(*species, *params)`` : nonzero entries of the Jacobian of `rhss`, lambdified.
+            * ``f_rhs(X, t, args)`` : see `self.gen_rhs`.
+            * ``f_jac(X, t, args)`` : see `self.gen_jac`.
+            * ``f_rhs_stacked(Y, t, args_sets)`` and ``f_jac_stacked(Y, t, args_sets)`` : see `self.gen_stacked`.
+
+        The Jacobian only spares the integrators from estimating it, so when it can't be generated (e.g. the derivative
+        of Abs is left as an unevaluated Derivative), `f_jac_model`, `f_jac` and `f_jac_stacked` are left out of the
+        module rather than failing the build.
+
+        The module imports everything the lambdified code refers to, so it can be loaded on its own.
+
+        Parameters
+        ----------
+        arg_symbols : list[sympy.Symbol]
+            Positional symbols for the species and parameters (see `self.positional_rhss`).
+        rhss : list[sympy.Expr]
+            Right hand sides in terms of `arg_symbols`.
+
+        Returns
+        -------
+        str
+        """
+        n_species = len(self.species)
+        f_model = sy.lambdify(arg_symbols, tuple(rhss), cse=True)
+        namespace = dict(f_model.__globals__)
+        sources = [inspect.getsource(f_model).replace('def _lambdifygenerated(', 'def f_model(', 1), self.gen_rhs()]
+
+        try:
+            jacobian = sy.Matrix(rhss).jacobian(arg_symbols[:n_species])
+            if jacobian.has(sy.Derivative):
+                raise ValueError('it contains unevaluated derivatives')
+            nonzero = [(i, j) for i in range(n_species) for j in range(n_species) if jacobian[i, j] != 0]
+            f_jac_model = sy.lambdify(arg_symbols, tuple(jacobian[i, j] for i, j in nonzero), cse=True)
+            jac_sources = [inspect.getsource(f_jac_model).replace('def _lambdifygenerated(', 'def f_jac_model(', 1),
+                           self.gen_jac(nonzero)]
+            # Check that everything the Jacobian refers to can be imported.
+            self.gen_imports('\n\n'.join(jac_sources), f_jac_model.__globals__)
+        except Exception as e:
+            warn('celltx ODELayer: Unable to generate the Jacobian of the model (%s); the integrators will estimate it '
+                 'instead.' % e)
+            jac_sources = []
+        else:
+            namespace.update(f_jac_model.__globals__)
+
+        body = '\n\n'.join(sources + jac_sources + [self.gen_stacked(jacobian=len(jac_sources) > 0)])
+        return '\n'.join(self.gen_imports(body, namespace)) + '\n\n\n' + body
+
+    def gen_imports(self, source, namespace):
+        """
+        Turn the names that `source` takes from lambdify's namespace into import statements.
+
+        Parameters
+        ----------
+        source : str
+            Generated source code.
+        namespace : dict
+            Globals of the lambdified functions in `source`.
+
+        Returns
+        -------
+        list[str]
+        """
+        imports = ['import numpy as np']
+        for name in sorted(set(re.findall(r'(?<![A-Za-z0-9_.])[A-Za-z_][A-Za-z0-9_]*', source))):
+            if name.startswith('__') or name not in namespace:
+                continue
+            val = namespace[name]
+            if inspect.ismodule(val):
+                imports.append('import %s as %s' % (val.__name__, name))
+                continue
+            for module_name in ['numpy', 'scipy.special', 'math', 'functools', 'builtins']:
+                module = importlib.import_module(module_name)
+                if getattr(module, name, None) is val:
+                    imports.append('from %s import %s' % (module_name, name))
+                    break
+            else:
+                raise ValueError('celltx ODELayer: Unable to find the module that provides %s.' % name)
+        return imports
+
+    def positional_rhss(self):
+        """
+        Rename the species and parameters in `self.ordered_rhss` to positional symbols (_x0, _x1, ..., _p0, _p1, ...),
+        so that the same equations always give the same expressions, and so the same generated code.
+
+        Returns
+        -------
+        tuple[list[sympy.Symbol], list[sympy.Expr]]
+            The positional symbols, and the right hand sides in terms of them.
+        """
+        arg_symbols = [sy.Symbol('_x%i' % i) for i in range(len(self.species))] + \
+                      [sy.Symbol('_p%i' % i) for i in range(len(self.params))]
+        positional = dict(zip(self.unique_args, arg_symbols))
+        return arg_symbols, [rhs.xreplace(positional) for rhs in self.ordered_rhss]
+
+    def load_model(self):
+        """
+        Load the compiled numerical functions of the model (see `self.gen_model_source`).
+
+        The generated module is stored in `CACHE_DIR` under a hash of the positional right hand sides (and of the code
+        that generates it), and its functions are njit'd with `cache=True`. So when the same model is built again, e.g.
+        in a new session or in the workers of a parameter search, the Jacobian, lambdify and numba compilation are all
+        skipped: the module is imported from disk and numba loads the machine code it stored next to it. If `CACHE_DIR`
+        can't be written to, the module is built in memory instead and compiled without caching.
+
+        Returns
+        -------
+        module
+            Module whose `f_model`, `f_jac_model`, `f_rhs`, `f_jac`, `f_rhs_stacked` and `f_jac_stacked` attributes are
+            njit'd. The Jacobian functions are missing if the Jacobian couldn't be generated.
+        """
+        arg_symbols, rhss = self.positional_rhss()
+        key = '%s\n%s\n%s' % (sy.__version__, _CODEGEN_HASH, sy.srepr(rhss))
+        module_name = 'celltx_model_%s' % hashlib.sha1(key.encode()).hexdigest()
+        path = os.path.join(CACHE_DIR, module_name + '.py')
+
+        source = None
+        cache = True
+        # Never rewrite an existing file: numba invalidates its cache when the source file changes.
+        if not os.path.exists(path):
+            source = self.gen_model_source(arg_symbols, rhss)
+            tmp_path = '%s.%i.tmp' % (path, os.getpid())
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    f.write(source)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                warn('celltx ODELayer: Unable to write to the model cache at %s (%s); compiling the model without '
+                     'caching it. Set CELLTX_CACHE_DIR to a writable directory to cache it.' % (CACHE_DIR, e))
+                cache = False
+
+        if cache:
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+        else:
+            module = types.ModuleType(module_name)
+        # numba looks the module up by name when it loads cached functions, so it has to be registered.
+        sys.modules[module_name] = module
+        if cache:
+            spec.loader.exec_module(module)
+        else:
+            exec(compile(source, module_name, 'exec'), module.__dict__)
+
+        # Each function calls the ones before it, so those must be dispatchers by the time it is compiled.
+        for name in ['f_model', 'f_jac_model', 'f_rhs', 'f_jac', 'f_rhs_stacked', 'f_jac_stacked']:
+            if hasattr(module, name):
+                setattr(module, name, njit(cache=cache)(getattr(module, name)))
+        return module
+
+    def jac(self, X, t, args):
+        """
+        Return the Jacobian of the system based on current state, desired timepoint, and param values (see
+        `self.gen_jac`).
+
+        Parameters
+        ----------
+        X : list[float]
+            List of values for all species in the model, in the same order as self.species.
+        t : float
+            Time at which the Jacobian is being evaluated.
+        args : list[float]
+            List of values for all parameters in the model, in the same order as self.params.
+
+        Returns
+        -------
+        np.ndarray[float]
+            (n_species, n_species) array of partial derivatives d(dX_i/dt)/dX_j.
+        """
+        if self.f_jac is None:
+            raise ValueError('celltx ODELayer: The Jacobian of this model could not be generated.')
+        return self.f_jac(np.asarray(X, dtype=np.float64), t, np.asarray(args, dtype=np.float64))
+
     def model(self, X, t, args):
         """
         Return the derivative of the system based on current state, desired timepoint, and param values.
         Effectively a wrapper for the lambda self.f_model that, for instance, prevents species from having negative values.
+        The evaluation itself happens in `self.f_rhs` (see `self.gen_rhs`).
 
         Parameters
         ----------
@@ -146,13 +536,10 @@ class ODELayer():
 
         Returns
         -------
-        list[float]
+        np.ndarray[float]
             Derivative of the value of each species in the model, in the same order as self.species.
         """
 
-        in_vals = np.concatenate((X, args))
-        out = self.f_model(*in_vals)
-
         # Hacky solution to the quantization problem
         # If the sign of the derivative for a species is negative and the value <1, set it and its derivative to 0.
         # for idx, dx in enumerate(out):
@@ -162,14 +549,8 @@ class ODELayer():
         #         print('celltx odelayer - quantization rule activated for species at index %i (value is %f). dx = %f. \
         #          Time = %f'%(idx, x_val, dx, t))
 
-        # If the current value of a var is 0, don't let the differential be less than zero
-        new_out = []
-        for i, val in enumerate(out):
-            if X[i] <= 0 and val < 0:
-                new_out.append(0)
-            else:
-                new_out.append(val)
-        return new_out
+        # If the current value of a var is 0, f_rhs doesn't let the differential be less than zero.
+        return self.f_rhs(X, t, np.asarray(args, dtype=np.float64))
 
     def index_of_species(self, species_name):
         """
@@ -184,9 +565,8 @@ class ODELayer():
         int
         """
 
-        for i, species in enumerate(self.species):
-            if species.name == species_name:
-                return i
+        if species_name in self._species_idx:
+            return self._species_idx[species_name]
         warn('Celltx ODELayer index_of_species was unable to find species named %s in the model.' % species_name)
 
     def index_of_parameter(self, parameter_name):
@@ -202,24 +582,23 @@ class ODELayer():
         int
         """
 
-        for i, parameter in enumerate(self.params):
-            if parameter.name == parameter_name:
-                return i
+        if parameter_name in self._param_idx:
+            return self._param_idx[parameter_name]
         warn('Celltx ODELayer index_of_parameter was unable to find parameter named %s in the model.' % parameter_name)
 
-    def integrate_quash_species(self, t, species_idxs, start_from=None, override_params=None, override_x0=None, r=1):
+    def integrate_quash_species(self, t, species_idxs, start_from=None, override_params=None, override_x0=None):
         """
         Goal is to account for the fact that species in a model should not be able to resurge from a value less than 1.
         In addition, since species at the `odelayer` abstraction level often actually represent individual states
         of true biological species (e.g. activated and unactivated T cells), it may be important to consider multiple
         species when attempting to quash a biological species.
 
-        Recursive algorithm:
+        Algorithm:
             1. Integrate `self.model` over timespace `t`.
-            2. Find (if it exists) the first timeopint `t_crit` at which all species in a group S (from species_idxs)
-                have fallen below 1.
-            3. Recurse, but start the simulation at `t_crit` and feed a modified x0 where species in S are set to 0.
-            4. Return the result if there is no t_crit.
+            2. Find (if it exists) the first timepoint `t_crit` at which all species in a group S (from species_idxs)
+                have fallen below 1. If there is none for any group, return the result.
+            3. Set the species in S to 0 at the timepoint before `t_crit`, integrate the rest of `t` again from there,
+                and drop S from the groups to consider. Go to 2, only searching from where the result changed.
 
         Parameters
         ----------
@@ -229,100 +608,64 @@ class ODELayer():
             List of tuples, where each tuple defines a group of species (addressed by indices in self.species) that
             should be quashed together.
         start_from : np.ndarray or None
-            Numpy array with a row for each species and a column for each timepoint. If it is provided, the simulation
-            will start at timepoint t[start_from.shape[0]] and the first start_from.shape[0] cols will be pasted in.
+            Numpy array with a row for each timepoint and a column for each species. If it is provided, the simulation
+            will start at timepoint t[start_from.shape[0]] and the first start_from.shape[0] rows will be pasted in.
 
         Returns
         -------
-        np.ndarray with a row for each species in the model and a column for each timepoint (in `t`).
+        np.ndarray with a row for each timepoint (in `t`) and a column for each species in the model.
 
         """
-        # print('multiquash called on species_idxs: %s'%species_idxs)
         # Make it work with the old input format for single species quash
-        if not isinstance(species_idxs, list):
+        if species_idxs is None:
+            species_idxs = []
+        elif not isinstance(species_idxs, list):
             species_idxs = [species_idxs]
 
-        # Warn about not fully tested functionality
-        # max_len = max([len(s) for s in species_idxs])
-        # if max_len > 1:
-        #     warn('celltx.odelayer.multiquash: Warning - the quash_species functionality has only been tested for '
-        #          'individual species; not multiple in the same group.')
+        # Copy, since groups are removed as they are quashed.
+        species_idxs = list(species_idxs)
 
         if start_from is not None:
-            # print('celltx.multiquash starting from timepoint %i with r index %i.' % (start_from.shape[0], r))
             calculated_block = self.integrate(t[start_from.shape[0]:], override_x0=start_from[-1, :],
                                               override_params=override_params)
-            X_initial = np.concatenate((start_from, calculated_block), axis=0)
+            X = np.concatenate((start_from, calculated_block), axis=0)
+            search_from = start_from.shape[0] - 1
         else:
-            # print('celltx.multiquash starting with a fresh integral; start_from was %s. rec = %i'%(start_from, r))
-            X_initial = self.integrate(t, override_params=override_params,
-                                       override_x0=override_x0)  # initial integration
-
-        d = [False for _ in
-             species_idxs]  # list to track the t_crit value for each species group (where it fell below 1)
-
-        # If there are no species left to quash, return
-        if len(species_idxs) == 0:
-            # print('celltx multiquash returning trivial integrand since species_idxs was empty')
-            return X_initial
-
-        # For each species_group, find the first timepoint t_crit where all subspecies were < 1 and store in d.
-        # If no such timepoint exists, store False in d.
-        # print('searching with species_idxs: %s'%species_idxs)
-        for i, species_group in enumerate(species_idxs):
-            for timepoint, _X in enumerate(X_initial):  # for each slice of the starting integration
-                t_crit = timepoint
-                for species in species_group:  # if any of the subspecies are >=1, this ain't it.
-                    if _X[species] >= 1:
-                        # print('rejecting timepoint %i for species %i bc value %.2f'%(timepoint, species, _X[species]))
-                        t_crit = False
-
-                if not isinstance(t_crit, type(False)):  # If t_crit is a number, we found our instance.
-                    # print('found t_crit %.2f for species group idx %i. '%(t_crit, i))
-                    break
-
-            d[i] = t_crit  # Store the value in d
-            # print('found d matrix %s' % d)
-
-        # If all values in d are False, return.
-        if sum(d) == 0:
-            all_booleans = True
-            for val in d:
-                if not isinstance(val, type(False)):
-                    all_booleans = False
-                if all_booleans:
-                    # print('celltx.odelayer.multiquash found nothing to quash!')
-                    # print('multiquash returning since all values in d are False %s'%d)
-                    return X_initial
-
-        # If all values are not False, find the first t_crit and corresponding species.
-        dd = [val if not isinstance(val, type(False)) else max(d) + 1 for val in
-              d]  # convert False values to large values
-        idx_to_quash = dd.index(min(dd))  # index of the species group in species_idxs
-        timepoint_to_quash = dd[idx_to_quash]  # timepoint where quashing starts
-        species_idxs_to_quash = species_idxs[idx_to_quash]  # tuple of subspecies to actually quash.
-
-        # Now, generate the start_from matrix for the recursion.
-        _done = X_initial[0:timepoint_to_quash, :]
-
-        # Set the value of each species in the group we're quashing to 0
-        for s in species_idxs_to_quash:
-            _done[timepoint_to_quash - 1, s] = 0
-
-        # Generate a species_idxs list that is missing the one we just quashed so that we don't get an infinite loop.
-        species_idxs.pop(idx_to_quash)
-
-        # Recurse
-        # print('celltx.odelayer.multiquash recursing')
-        # print('about to recurse (r=%i)'%r)
-        return self.integrate_quash_species(t, species_idxs, start_from=_done, override_params=override_params, r=r+1)
+            X = self.integrate(t, override_params=override_params, override_x0=override_x0)  # initial integration
+            search_from = 0
+
+        while len(species_idxs) > 0:
+            # For each species_group, find the first timepoint t_crit (at or after `search_from`) where all
+            # subspecies were < 1. If no such timepoint exists, store None.
+            d = []
+            for species_group in species_idxs:
+                below = (X[search_from:, list(species_group)] < 1).all(axis=1)
+                d.append(search_from + int(below.argmax()) if below.any() else None)
+
+            # If there is nothing left to quash, we're done.
+            found = [t_crit for t_crit in d if t_crit is not None]
+            if len(found) == 0:
+                break
+
+            # Quash the group that fell below 1 first, and stop considering it so that we don't loop forever.
+            timepoint_to_quash = min(found)
+            species_idxs_to_quash = species_idxs.pop(d.index(timepoint_to_quash))
+
+            # Set the group to 0 at the preceding timepoint and integrate the remainder of `t` from there. Earlier
+            # timepoints are unchanged, so later searches can start at `restart`.
+            restart = max(timepoint_to_quash - 1, 0)
+            X[restart, list(species_idxs_to_quash)] = 0
+            X[restart + 1:, :] = self.integrate(t[restart + 1:], override_x0=X[restart, :],
+                                                override_params=override_params)
+            search_from = restart
+
+        return X
 
     def integrate(self, t, override_x0=None, override_params=None):
         """
         Integrate the model at timepoints in t using literal parameter values.
         """
-        # Assemble the parameter values into a list.
-        params = [float(param.expr) for param in self.params]
+        params = self._param_values
 
         if override_params is not None:
             params = override_params
@@ -332,35 +675,261 @@ class ODELayer():
         if override_x0 is not None:
             _x0 = override_x0
 
-        x = odeint(self.model, _x0, t, args=(params,))
+        x = self.solve(_x0, t, params)
         return x
 
+    def solve(self, x0, t, params):
+        """
+        Integrate the model from `x0` at timepoints in `t` with parameter values `params`, using the integrator named by
+        `self.backend`. All simulations go through this function.
+
+        'odeint' uses LSODA via `scipy.integrate.odeint`. 'solve_ivp' uses LSODA via `scipy.integrate.solve_ivp` with
+        the same tolerances as odeint. Both call the compiled `self.f_rhs` and `self.f_jac` directly, rather than going
+        through the `self.model` and `self.jac` wrappers. 'rk4' runs the fixed step Runge-Kutta integrator from
+        `celltx.odelayer.integrator` entirely in compiled code, taking `self.rk4_substeps` steps between timepoints; it
+        has no error control, so it is only appropriate for non-stiff models and small enough steps. If it diverges
+        (the result isn't finite), the simulation is repeated with odeint. 'dopri5' runs the adaptive Dormand-Prince
+        5(4) integrator from `celltx.odelayer.integrator` entirely in compiled code. It is explicit, so it gives up as
+        soon as it detects that the model is stiff (or after `self.dopri5_max_steps`), in which case the simulation is
+        repeated with odeint.
+
+        Parameters
+        ----------
+        x0 : np.ndarray
+            Initial value of each species.
+        t : np.ndarray
+            Timepoints at which to report the state of the model. The integration starts at t[0].
+        params : np.ndarray
+            Value of each parameter, in the same order as `self.params`.
+
+        Returns
+        -------
+        np.ndarray with a row for each timepoint (in `t`) and a column for each species in the model.
+        """
+        x0 = np.asarray(x0, dtype=np.float64)
+        params = np.asarray(params, dtype=np.float64)
+        f_rhs = self.f_rhs
+        f_jac = self.f_jac
+
+        if self.backend == 'odeint':
+            return odeint(f_rhs, x0, t, args=(params,), Dfun=f_jac, rtol=self.rtol, atol=self.atol,
+                          mxstep=self.odeint_mxstep)
+
+        if self.backend == 'solve_ivp':
+            jac = None if f_jac is None else lambda _t, X: f_jac(X, _t, params)
+            sol = solve_ivp(lambda _t, X: f_rhs(X, _t, params), (t[0], t[-1]), x0, method='LSODA', t_eval=t, jac=jac,
+                            rtol=self.rtol, atol=self.atol)
+            if not sol.success:
+                raise RuntimeError('solve_ivp failed: %s' % sol.message)
+            return sol.y.T
+
+        if self.backend == 'rk4':
+            x = rk4(f_rhs, x0, np.asarray(t, dtype=np.float64), params, self.rk4_substeps)
+            if np.isfinite(x).all():
+                return x
+            warn('celltx ODELayer: rk4 diverged (the model may be stiff, or self.rk4_substeps too small); falling back '
+                 'to odeint.')
+            return odeint(f_rhs, x0, t, args=(params,), Dfun=f_jac, rtol=self.rtol, atol=self.atol,
+                          mxstep=self.odeint_mxstep)
+
+        if self.backend == 'dopri5':
+            x, success = dopri5(f_rhs, x0, np.asarray(t, dtype=np.float64), params, self.rtol, self.atol,
+                                self.dopri5_max_steps)
+            if success:
+                return x
+            warn('celltx ODELayer: dopri5 did not finish (the model may be stiff); falling back to odeint.')
+            return odeint(f_rhs, x0, t, args=(params,), Dfun=f_jac, rtol=self.rtol, atol=self.atol,
+                          mxstep=self.odeint_mxstep)
+
+        raise ValueError('celltx ODELayer: Unknown integration backend %s.' % self.backend)
+
+    def solve_ensemble(self, x0s, t, param_sets, parallel):
+        """
+        Integrate the model once for each row of `x0s` and `param_sets`, as `self.solve` would, but with many
+        simulations at a time. The backends in `ENSEMBLE_BACKENDS` support this (see `self.backend`).
+
+        'rk4' and 'dopri5' run all simulations in a single compiled call spread over `parallel` numba threads (see
+        `celltx.odelayer.integrator`); simulations that rk4 diverges on or dopri5 can't finish are repeated with odeint.
+        'odeint' stacks up to `self.odeint_batch_size` simulations into one system and integrates it with a single
+        odeint call (see `self.solve_stacked`), with the batches spread over a pool of `parallel` processes.
+
+        Parameters
+        ----------
+        x0s : np.ndarray
+            Array with a row of initial values for each simulation.
+        t : np.ndarray
+            Timepoints at which to report the state of the model. The integration starts at t[0].
+        param_sets : np.ndarray
+            Array with a row of parameter values for each simulation, in the same order as `self.params`.
+        parallel : int
+            Number of threads (for 'odeint', processes) to use.
+
+        Returns
+        -------
+        list
+            Timecourse for each simulation (see `self.solve`), or the exception raised while integrating it. If
+            integrating many simulations at once raises, they are integrated one at a time (see `self.solve_each`), so
+            that a failing simulation doesn't take the others with it.
+        """
+        x0s = np.ascontiguousarray(x0s, dtype=np.float64)
+        param_sets = np.ascontiguousarray(param_sets, dtype=np.float64)
+        t = np.asarray(t, dtype=np.float64)
+
+        if self.backend == 'odeint' and parallel > 1:
+            # Compile the stacked functions before forking, so the workers inherit them rather than each compiling them.
+            self.f_rhs_stacked.compile(_STACKED_SIGNATURE)
+            if self.f_jac_stacked is not None:
+                self.f_jac_stacked.compile(_STACKED_SIGNATURE)
+            # odeint holds the GIL, so spread the batches over processes, making sure there are enough to go around.
+            size = max(1, min(self.odeint_batch_size, -(-x0s.shape[0] // parallel)))
+            batches = [(x0s[i:i + size], param_sets[i:i + size]) for i in range(0, x0s.shape[0], size)]
+            return [X for Xs in self.map_simulations(_solve_batch, batches, t, parallel, None) for X in Xs]
+
+        try:
+            if self.backend == 'odeint':
+                size = self.odeint_batch_size
+                results = []
+                for i in range(0, x0s.shape[0], size):
+                    results.extend(self.solve_stacked(x0s[i:i + size], t, param_sets[i:i + size]))
+                return results
+
+            # Only start numba's threads for the backends that use them. Under numba's default TBB threading layer,
+            # forking (e.g. in `self.map_simulations`) once they are running leaves the process hanging at exit, so
+            # unless a layer was chosen (e.g. with NUMBA_THREADING_LAYER), use the fork-safe workqueue layer. The
+            # layer is picked when the threads start, so this has no effect once they are running.
+            if numba.config.THREADING_LAYER == 'default':
+                numba.config.THREADING_LAYER = 'workqueue'
+            numba.set_num_threads(max(1, min(parallel, numba.config.NUMBA_NUM_THREADS)))
+
+            if self.backend == 'rk4':
+                Xs = rk4_ensemble(self.f_rhs, x0s, t, param_sets, self.rk4_substeps)
+                success = np.isfinite(Xs).all(axis=(1, 2))
+                results = list(Xs)
+                if not success.all():
+                    warn('celltx ODELayer: rk4 diverged in %i simulations (the model may be stiff, or '
+                         'self.rk4_substeps too small); falling back to odeint for those.' % np.count_nonzero(~success))
+                    for i in np.flatnonzero(~success):
+                        results[i] = odeint(self.f_rhs, x0s[i], t, args=(param_sets[i],), Dfun=self.f_jac,
+                                            rtol=self.rtol, atol=self.atol, mxstep=self.odeint_mxstep)
+                return results
+
+            if self.backend == 'dopri5':
+                Xs, success = dopri5_ensemble(self.f_rhs, x0s, t, param_sets, self.rtol, self.atol,
+                                              self.dopri5_max_steps)
+                results = list(Xs)
+                if not success.all():
+                    warn('celltx ODELayer: dopri5 did not finish %i simulations (the model may be stiff); falling back '
+                         'to odeint for those.' % np.count_nonzero(~success))
+                    for i in np.flatnonzero(~success):
+                        results[i] = odeint(self.f_rhs, x0s[i], t, args=(param_sets[i],), Dfun=self.f_jac,
+                                            rtol=self.rtol, atol=self.atol, mxstep=self.odeint_mxstep)
+                return results
+        except Exception as e:
+            warn('celltx ODELayer: Integrating %i simulations at once failed (%s); integrating them one at a time.' % (
+                x0s.shape[0], e))
+            return self.solve_each(x0s, t, param_sets)
+
+        raise ValueError('celltx ODELayer: Backend %s does not support ensembles.' % self.backend)
+
+    def solve_each(self, x0s, t, param_sets):
+        """
+        Integrate the model once for each row of `x0s` and `param_sets` with `self.solve`, one simulation at a time.
+
+        Parameters
+        ----------
+        x0s : np.ndarray
+            Array with a row of initial values for each simulation.
+        t : np.ndarray
+            Timepoints at which to report the state of the model. The integration starts at t[0].
+        param_sets : np.ndarray
+            Array with a row of parameter values for each simulation, in the same order as `self.params`.
+
+        Returns
+        -------
+        list
+            Timecourse for each simulation (see `self.solve`), or the exception raised while integrating it.
+        """
+        results = []
+        for x0, params in zip(x0s, param_sets):
+            try:
+                results.append(self.solve(x0, t, params))
+            except Exception as e:
+                print('ODELayer encountered exception while integrating: %s' % e)
+                results.append(e)
+        return results
+
+    def solve_stacked(self, x0s, t, param_sets):
+        """
+        Integrate the model once for each row of `x0s` and `param_sets` with a single odeint call, by stacking the
+        simulations into one system (see `self.gen_stacked`). This shares LSODA's setup and the Python overhead of each
+        step among all of them, and the block diagonal Jacobian is passed to LSODA as a band matrix.
+
+        The simulations share their steps, so the results agree with `self.solve` to within the tolerances rather than
+        exactly. If the stacked integration fails or raises, each simulation is integrated on its own (see
+        `self.solve_each`).
+
+        Parameters
+        ----------
+        x0s : np.ndarray
+            Array with a row of initial values for each simulation.
+        t : np.ndarray
+            Timepoints at which to report the state of the model. The integration starts at t[0].
+        param_sets : np.ndarray
+            Array with a row of parameter values for each simulation, in the same order as `self.params`.
+
+        Returns
+        -------
+        list
+            Timecourse for each simulation (see `self.solve`), or the exception raised while integrating it.
+        """
+        if x0s.shape[0] == 1:
+            return self.solve_each(x0s, t, param_sets)
+
+        n = x0s.shape[1]
+        try:
+            Y, info = odeint(self.f_rhs_stacked, x0s.ravel(), t, args=(param_sets,), Dfun=self.f_jac_stacked,
+                             ml=n - 1, mu=n - 1, rtol=self.rtol, atol=self.atol, mxstep=self.odeint_mxstep,
+                             full_output=True)
+            message = info['message']
+        except Exception as e:
+            message = str(e)
+        if message != 'Integration successful.':
+            warn('celltx ODELayer: Stacked odeint failed (%s); integrating its %i simulations one at a time.' % (
+                message, x0s.shape[0]))
+            return self.solve_each(x0s, t, param_sets)
+        # Y has a row for each timepoint holding every simulation; split it back into one timecourse per simulation.
+        return list(Y.reshape(t.shape[0], x0s.shape[0], n).transpose(1, 0, 2))
+
     def set_initial_value(self, idx, val):
         self.x0[idx] = val
 
     def set_initial_value_byname(self, name, val):
-        for i, species in enumerate(self.species):
-            if species.name == name:
-                self.x0[i] = val
-                return
+        if name in self._species_idx:
+            self.x0[self._species_idx[name]] = val
+            return
 
         print('celltx.ODELayer: Error finding species %s.' % name)
 
     def set_param_value(self, name, val):
-        for i, param in enumerate(self.params):
-            if param.name == name:
-                new = param
-                new.expr = val
-                self.params[i] = new
+        if name in self._param_idx:
+            i = self._param_idx[name]
+            new = self.params[i]
+            new.expr = val
+            self.params[i] = new
+            self._param_values[i] = float(new.expr)
+            if name not in self.param_search_ranges:
+                self._param_lo[i] = self._param_hi[i] = self._param_values[i]
 
     def get_param_value(self, name):
-        for param in self.params:
-            if param.name == name:
-                return param.expr
+        if name in self._param_idx:
+            return self.params[self._param_idx[name]].expr
         warn('celltx ODELayer could not find param with name %s' % name)
 
     def set_param_search_range(self, param_name, rnge):
         self.param_search_ranges[param_name] = rnge
+        if self._param_idx is not None and param_name in self._param_idx:
+            i = self._param_idx[param_name]
+            self._param_lo[i], self._param_hi[i] = rnge
 
     def set_x0_search_range(self, x0_idx, rnge):
         self.x0_search_ranges[x0_idx] = rnge
@@ -371,6 +940,11 @@ class ODELayer():
         `self.set_x0_search_range`. First, generate `n_samples` sets of input values using `method`, and then simulate
         (possibly in n-`parallel`), the model timecourse for each sample.
 
+        Without `quash_species`, the simulations are integrated with `self.solve_ensemble`. With the default 'odeint'
+        backend, that stacks `self.odeint_batch_size` simulations at a time into one system (see `self.solve_stacked`),
+        so the results agree with `self.integrate` to within the tolerances rather than exactly. Set
+        `self.odeint_batch_size` to 1 to integrate them one at a time.
+
         Parameters
         ----------
         t : np.ndarray
@@ -397,82 +971,46 @@ class ODELayer():
         print('celltx ODELayer: Running parallel simulations on %i processors.' % parallel)
         tic = time.time()
 
-        chunked_argspace_samples = self.chunks(argspace_samples, parallel)
-
-        manager = mp.Manager()
-        reservoir = manager.list()
-
-        jobs = []
-
-        for i, chk in enumerate(chunked_argspace_samples):
-            proc = mp.Process(target=self.process_argspace_chunk, args=(chk, reservoir, t, i, quash_species))
-            jobs.append(proc)
-            proc.start()
-
-        for process in jobs:
-            process.join()
-            process.terminate()
+        if self.backend in ENSEMBLE_BACKENDS and not quash_species:
+            # The whole search can be integrated in one compiled, multithreaded call.
+            a = self.simulate_argspace_ensemble(argspace_samples, t, parallel)
+        else:
+            a = self.map_simulations(_simulate_argset, argspace_samples, t, parallel, quash_species)
 
         print('celltx ODELayer: Finished all %i simulations in %s.' % (
         int(n_samples), format_timedelta(time.time() - tic)))
-        a = list(reservoir)
 
+        # Assort the arg vals from each simulation into a dictionary keyed by their names.
+        # As per gen_argspace_samples, order is all species followed by all params.
+        keys = [species.name for species in self.species] + [param.name for param in self.params]
         for l in a:
-
-            # Assort the arg vals from the simulation into a dictionary keyed by their names.
-            # As per gen_argspace_samples, order is all species followed by all params.
-
-            arg_vals = l[0]
-            d = {}
-            keys = []
-            for species in self.species:
-                keys.append(species.name)
-            for param in self.params:
-                keys.append(param.name)
-
-            for i, pv in enumerate(arg_vals):
-                d[keys[i]] = pv
-            l[0] = d
+            l[0] = dict(zip(keys, l[0]))
 
         return a
 
-    def process_argspace_chunk(self, chk, out, t, i, quash_species):
+    def simulate_argspace_ensemble(self, argspace_samples, t, parallel):
         """
-        Process a chunk of argspace samples. This function is used for parallelizations.
+        Simulate all argspace samples with `self.solve_ensemble`, which integrates many of them at a time rather than
+        one per task.
 
         Parameters
         ----------
-        chk : list
-            list of lists, where each list has a value for each species and each parameter (in order of self.x)
-        out : multiprocess.reservoir
-            reservoir to send the outputs
+        argspace_samples : np.ndarray
+            Array with a row for each sample, holding a value for each species followed by each parameter.
         t : np.ndarray
-            timeframe to integrate
-        i : int
-            Index of the processor (for reporting realtime progress)
-        quash_species : list of lists
-            groups of species to quash
-        """
-        # print('processing chunk with quashed species: %s' % quash_species)
-
-        pbar = tqdm(chk, position=i, file=sys.stdout)
-        pbar.set_description('Processor %i Progress' % (i + 1))
-
-        for arg_set in pbar:
-            output = []
-            try:
-                # Divide the arg_set into x0 and params. Order is from self.species and self.params.
-                x0 = arg_set[0:len(self.species)]
-                params = arg_set[len(self.species):]
-                # print('calling iqs with quash_species=%s'%quash_species)
-                X = self.integrate_quash_species(t=t, species_idxs=copy.deepcopy(quash_species), override_params=params, override_x0=x0)
-
-                output = [arg_set, X]
+            The timeframe over which to integrate for each sample
+        parallel : int
+            Number of threads (for 'odeint', processes) to use
 
-            except Exception as e:
-                print('ODELayer encountered exception while integrating: %s' % e)
-                output = [arg_set, e]
-            out.append(output)
+        Returns
+        -------
+        list of 2-lists, where list[0] is the sample and list[1] is its timecourse (or the exception raised while
+        integrating).
+        """
+        arg_sets = np.asarray(argspace_samples, dtype=np.float64)
+        n_species = len(self.species)
+        Xs = self.solve_ensemble(arg_sets[:, :n_species], t, arg_sets[:, n_species:], parallel)
+        return [[arg_set, X] for arg_set, X in zip(argspace_samples, Xs)]
 
     def pin_params_for_search(self, param_names):
         """
@@ -495,22 +1033,13 @@ class ODELayer():
         and self.x0_search_ranges)
         """
         # Order of ranges will be all species followed by all params.
-        ranges = []
-        for idx, species in enumerate(self.species):
-            ranges.append([self.x0[idx], self.x0[idx]])
+        x0_lo = np.array(self.x0, dtype=np.float64)
+        x0_hi = x0_lo.copy()
+        for species_idx, rnge in self.x0_search_ranges.items():
+            x0_lo[species_idx], x0_hi[species_idx] = rnge
 
-        for species_idx in self.x0_search_ranges:
-            ranges[species_idx] = self.x0_search_ranges[species_idx]
-
-        for param in self.params:
-            if param.name in self.param_search_ranges:
-                ranges.append(self.param_search_ranges[param.name])
-            else:
-                ranges.append([param.expr, param.expr])
-
-        ranges = np.array(ranges)
-        s = LHS(xlimits=ranges)
-        arg_sets = s(n_samples)
+        ranges = np.column_stack((np.concatenate((x0_lo, self._param_lo)), np.concatenate((x0_hi, self._param_hi))))
+        arg_sets = self.latin_hypercube_samples(ranges, n_samples)
 
         # now handle the `self.pinned_params`: For each pin tuple, get the indices of the params and make the parameter
         # sample values the same (we'll take the generated samples from the first one.
@@ -520,20 +1049,21 @@ class ODELayer():
         for pin_set in self.pinned_params:
             pin_indices = [self.index_of_parameter(p) + len(self.species) for p in pin_set]
 
-            for i, sample in enumerate(arg_sets):
-                for j, pin_index in enumerate(pin_indices):
-                    # skip over the first instance
-                    if j == 0:
-                        continue
-                    # for subsequent instances, copy the 0th instance value to the jth value.
-                    arg_sets[i][pin_index] = sample[pin_indices[0]]
+            # For every sample, copy the value of the 0th instance to each subsequent instance.
+            arg_sets[:, pin_indices[1:]] = arg_sets[:, pin_indices[0:1]]
 
         return arg_sets
 
     def execute_paramspace_search(self, t, n_samples, parallel, method='LHS', quash_species=None):
         """
-        Sample parameter values from parameter-specific ranges specified in self.search_ranges (dict) and simulate.
-        Parameters that don't have an entry in self.search_ranges are not to be sampled.
+        Sample parameter values from parameter-specific ranges specified in self.param_search_ranges (dict, see
+        `self.set_param_search_range`) and simulate. Parameters that don't have an entry in self.param_search_ranges are
+        not to be sampled.
+
+        Without `quash_species`, the simulations are integrated with `self.solve_ensemble`. With the default 'odeint'
+        backend, that stacks `self.odeint_batch_size` simulations at a time into one system (see `self.solve_stacked`),
+        so the results agree with `self.integrate` to within the tolerances rather than exactly. Set
+        `self.odeint_batch_size` to 1 to integrate them one at a time.
 
         Parameters
         ----------
@@ -552,76 +1082,117 @@ class ODELayer():
         print('celltx ODELayer: Running parallel simulations on %i processors.' % parallel)
         tic = time.time()
 
-        chunked_paramsets = self.chunks(parameter_sets, parallel)
-
-        manager = mp.Manager()
-        reservoir = manager.list()
-
-        jobs = []
-
-        for i, chk in enumerate(chunked_paramsets):
-            proc = mp.Process(target=self.process_paramset_chunk, args=(chk, reservoir, t, i, quash_species))
-            jobs.append(proc)
-            proc.start()
-
-        for process in jobs:
-            process.join()
-            process.terminate()
+        a = self.simulate_paramsets(parameter_sets, t, parallel, quash_species=quash_species)
 
         print("celltx ODELayer: Finished all %i simulations in: %s." % (
         int(n_samples), format_timedelta(time.time() - tic)))
-        a = list(reservoir)
 
         # Comprehend l[0] for l in a into a dictionary keyed by self.params names.
-
+        keys = [param.name for param in self.params]
         for l in a:
-            param_vals = l[0]
-            d = {}
-            for i, pv in enumerate(param_vals):
-                d[self.params[i].name] = pv
-            l[0] = d
+            l[0] = dict(zip(keys, l[0]))
 
         return a
 
-    def process_paramset_chunk(self, chk, out, t, i, quash_species):
-        pbar = tqdm(chk, position=i, file=sys.stdout)
-        pbar.set_description('Processor %i Progress' % (i + 1))
-        for parameter_set in pbar:
-            output = []
-            try:
+    def simulate_paramsets(self, parameter_sets, t, parallel, quash_species=None):
+        """
+        Simulate the model from `self.x0` once for each set of parameter values with `self.solve_ensemble`, or, when
+        quashing, one set at a time on a pool of `parallel` processes.
 
-                result = odeint(self.model, self.x0, t, args=(parameter_set,))
-                output = [parameter_set, result]
-            except Exception as e:
-                print('ODELayer encountered exception while integrating: %s' % e)
-                output = [parameter_set, e]
-            out.append(output)
-
-    def chunks(self, lst, nChunks):
-        """Divide a list into n lists where all chunks have even size, except for the last one, which is smaller."""
-        out = []
-        chunkSize = math.floor(len(lst) / nChunks)
-        for i in range(0, nChunks):
-            start = i * chunkSize
-            if i == nChunks - 1:
-                out.append(lst[start:])
-            else:
-                out.append(lst[start:start + chunkSize])
-        return out
+        Parameters
+        ----------
+        parameter_sets : list[list[float]]
+            Parameter values for each simulation, in the same order as self.params.
+        t : np.ndarray
+            The timeframe over which to integrate for each set
+        parallel : int
+            Number of processing cores to use
+        quash_species : None or list of lists
+            Groups of species to quash during each simulation (see `self.integrate_quash_species`).
+
+        Returns
+        -------
+        list of 2-lists, where list[0] is a parameter set and list[1] is the resulting timecourse (or the exception
+        raised while integrating it), in the same order as `parameter_sets`.
+        """
+        if self.backend in ENSEMBLE_BACKENDS and not quash_species:
+            # Integrate many sets at a time rather than one per task.
+            x0s = np.tile(np.asarray(self.x0, dtype=np.float64), (len(parameter_sets), 1))
+            Xs = self.solve_ensemble(x0s, t, np.asarray(parameter_sets, dtype=np.float64), parallel)
+            return [[parameter_set, X] for parameter_set, X in zip(parameter_sets, Xs)]
+
+        return self.map_simulations(_simulate_paramset, parameter_sets, t, parallel, quash_species)
+
+    def map_simulations(self, worker, samples, t, parallel, quash_species):
+        """
+        Run `worker` on each (index, sample) pair of `samples` on a pool of `parallel` processes, reporting progress on
+        a single bar in this process.
+
+        Parameters
+        ----------
+        worker : function
+            Module level function that simulates an (index, sample) pair and returns (index, output).
+        samples : list
+            Samples to simulate.
+        t : np.ndarray
+            The timeframe over which to integrate for each sample
+        parallel : int
+            Number of processing cores to use
+        quash_species : None or list of lists
+            Groups of species to quash during each simulation (see `self.integrate_quash_species`).
+
+        Returns
+        -------
+        list
+            The output for each sample, in the same order as `samples`.
+        """
+        n_samples = len(samples)
+        # A few chunks per worker amortizes the IPC without leaving workers idle at the end.
+        chunksize = max(1, n_samples // (parallel * 8))
+
+        # The layer, t and quash_species are handed to each worker once, rather than pickled with every task.
+        with mp.Pool(parallel, initializer=_init_worker, initargs=(self, t, quash_species)) as pool:
+            results = list(tqdm(pool.imap_unordered(worker, enumerate(samples), chunksize=chunksize),
+                                total=n_samples, file=sys.stdout))
+
+        # Workers finish in arbitrary order, so restore the order of `samples`.
+        return [output for _, output in sorted(results, key=lambda o: o[0])]
 
     def gen_paramspace_samples(self, n_samples):
-        """Use Latin Hypercube Sampling to generate samples of the parameter space (looking at self.search_ranges)"""
-        ranges = []
-        for param in self.params:
-            if param.name in self.search_ranges:
-                ranges.append(self.search_ranges[param.name])
-            else:
-                ranges.append([param.expr, param.expr])
-        ranges = np.array(ranges)
-        s = LHS(xlimits=ranges)
-        param_sets = s(n_samples)
+        """Use Latin Hypercube Sampling to generate samples of the parameter space (looking at
+        self.param_search_ranges)"""
+        ranges = np.column_stack((self._param_lo, self._param_hi))
+        param_sets = self.latin_hypercube_samples(ranges, n_samples)
         return param_sets
 
+    def latin_hypercube_samples(self, ranges, n_samples):
+        """
+        Draw `n_samples` Latin Hypercube samples from the box defined by `ranges`.
+
+        Parameters
+        ----------
+        ranges : list[list[float]]
+            [lower, upper] bounds for each dimension. Dimensions with lower == upper are held at that value.
+        n_samples : int
+            Number of samples to draw.
+
+        Returns
+        -------
+        np.ndarray
+            Array with a row for each sample and a column for each dimension.
+        """
+        ranges = np.array(ranges, dtype=np.float64)
+        samples = np.tile(ranges[:, 0], (n_samples, 1))
+
+        # Only sample the dimensions that actually vary; the others are already filled in with their fixed value.
+        varying = ranges[:, 0] != ranges[:, 1]
+        if varying.any():
+            lower = ranges[varying, 0]
+            upper = ranges[varying, 1]
+            unit_samples = qmc.LatinHypercube(d=int(varying.sum())).random(n_samples)
+            samples[:, varying] = lower + unit_samples * (upper - lower)
+        return samples
+
     def display_equations(self, display_func, substitute=False):
         """
         Print out the model equations. Display_func is IPython.display.display.
@@ -649,9 +1220,9 @@ class ODELayer():
 
         print("\nMODEL PARAMETERS (index | name | value)")
         for i, param in enumerate(self.params):
-            print("%i | %s | %s" % (i, param, "{:.2e}".format(float(param.expr))))
+            print("%i | %s | %s" % (i, param, "{:.2e}".format(self._param_values[i])))
 
-    def profile_parameter(self, param_name, values, t):
+    def profile_parameter(self, param_name, values, t, parallel=1):
         """
         Profile the model behavior for timeframe t across values of a parameter in `values` array.
 
@@ -666,6 +1237,10 @@ class ODELayer():
         t : np.ndarray[numpy.float64]
             Timepoint(s) at which to report the state of the model
 
+        parallel : int
+            Number of processing cores to use. If greater than 1, the values are simulated via
+            `self.simulate_paramsets`.
+
         Returns
         -------
         np.ndarray[np.ndarray]
@@ -673,21 +1248,30 @@ class ODELayer():
 
         """
         # Setup the default parameter array
-        idx_of_target_param = None
-        params = []
-        for idx, param in enumerate(self.params):
-            params.append(param.expr)
-            if param.name == param_name:
-                idx_of_target_param = idx
+        idx_of_target_param = self.index_of_parameter(param_name)
+        if idx_of_target_param is None:
+            return []
+        params = self._param_values.copy()
 
         # For each parameter value
         final = []
         print('celltx ODELayer executing parameter profile simulations for parameter %s.' % param_name)
+
+        if parallel > 1:
+            parameter_sets = np.tile(params, (len(values), 1))
+            parameter_sets[:, idx_of_target_param] = values
+
+            for value, (_, result) in zip(values, self.simulate_paramsets(parameter_sets, t, parallel)):
+                if isinstance(result, Exception):
+                    print("celltx ODELayer encountered exception while evaluating model: %s" % result)
+                    continue
+                final.append([value, result])
+            return final
+
         for value in tqdm(values):
             try:
                 params[idx_of_target_param] = value
-                params = [float(val) for val in params]
-                result = odeint(self.model, self.x0, t, args=(params,))
+                result = self.solve(self.x0, t, params)
                 output = [value, result]
                 final.append(output)
             except Exception as e:
@@ -728,24 +1312,75 @@ class ODELayer():
         for arg in expression.args:
             output.append((arg, []))
 
+        # Constants have the same value at every timepoint, so substitute them once up front. Term order doesn't matter
+        # here, so the selectors and constants are found with atoms() rather than by raveling the expression.
+        args = []
+        for arg in expression.args:
+            arg = arg.xreplace({term: sy.sympify(term.expr) for term in arg.atoms(Constant)})
+            indices = {}
+            for term in arg.atoms(Selector):
+                indices[term] = self._species_idx.get(term.name, -1)
+                if indices[term] == -1:
+                    warn("An internal error occurred; index == -1")
+            args.append((arg, indices))
+
         for tp in tqdm(range(len(X))):  # for each timepoint
-            for j, arg in enumerate(expression.args):
-                # substitute each term in the arg with the appropriate value.
-                for term in self.ravel_expression(arg):
-                    if isinstance(term, Constant):
-                        arg = arg.subs(term, term.expr)
-                    elif isinstance(term, Selector):
-                        # get the value of the selector at the current timepoint
-                        index = -1
-                        for i, species in enumerate(self.species):
-                            if species.selector == term.selector:
-                                index = i
-                        if index == -1:
-                            warn("An internal error occurred; index == -1")
-                        value = X[tp, index]
-                        arg = arg.subs(term, value)
-                    else:
-                        warn("Found term in equation that is neither selector nor arg.")
-                output[j][1].append(arg)
+            for j, (arg, indices) in enumerate(args):
+                # substitute the value of each selector at the current timepoint, all in one pass.
+                values = {term: sy.sympify(X[tp, index]) for term, index in indices.items()}
+                output[j][1].append(arg.xreplace(values))
 
         return output
+
+
+# State of a `map_simulations` pool worker, set once by `_init_worker`.
+_worker = {}
+
+
+def _init_worker(layer, t, quash_species):
+    _worker['layer'] = layer
+    _worker['t'] = np.asarray(t, dtype=np.float64)
+    _worker['x0'] = np.asarray(layer.x0, dtype=np.float64)
+    _worker['quash_species'] = quash_species
+
+
+def _simulate_paramset(job):
+    """Simulate one (index, parameter_set) pair in a `map_simulations` pool worker."""
+    idx, parameter_set = job
+    layer = _worker['layer']
+    try:
+        args = np.asarray(parameter_set, dtype=np.float64)
+        if _worker['quash_species']:
+            result = layer.integrate_quash_species(_worker['t'], _worker['quash_species'], override_params=args)
+        else:
+            result = layer.solve(_worker['x0'], _worker['t'], args)
+        output = [parameter_set, result]
+    except Exception as e:
+        print('ODELayer encountered exception while integrating: %s' % e)
+        output = [parameter_set, e]
+    return idx, output
+
+
+def _solve_batch(job):
+    """Integrate one (index, (x0s, param_sets)) batch with `ODELayer.solve_ensemble` in a `map_simulations` pool
+    worker."""
+    idx, (x0s, param_sets) = job
+    return idx, _worker['layer'].solve_ensemble(x0s, _worker['t'], param_sets, 1)
+
+
+def _simulate_argset(job):
+    """Simulate one (index, arg_set) pair, where arg_set holds a value for each species followed by each parameter, in
+    a `map_simulations` pool worker."""
+    idx, arg_set = job
+    layer = _worker['layer']
+    try:
+        # Divide the arg_set into x0 and params. Order is from self.species and self.params.
+        x0 = arg_set[0:len(layer.species)]
+        params = arg_set[len(layer.species):]
+        X = layer.integrate_quash_species(t=_worker['t'], species_idxs=_worker['quash_species'],
+                                          override_params=params, override_x0=x0)
+        output = [arg_set, X]
+    except Exception as e:
+        print('ODELayer encountered exception while integrating: %s' % e)
+        output = [arg_set, e]
+    return idx, output
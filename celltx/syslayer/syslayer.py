@@ -2,7 +2,9 @@
 # Laboratories of Hana El-Samad and Wendell A. Lim
 # University of California, San Francisco
 
-from ..functions import Selector, Constant
+from warnings import warn
+
+from ..functions import Selector
 from .. import graphlayer
 
 
@@ -17,7 +19,7 @@ class SysLayer:
         # 'type' : kind (tx_cell, cytokine, cell, element)
         # 'name' : name unique within kind
         # 'comparment' : (optional) comparment of membership
-        # 'states' : (optional) array of binary states
+        # 'states' : (optional) array of binary states, or None
 
         self.relationships = []
         # relationships between element singlets as dictionaries with:
@@ -26,6 +28,10 @@ class SysLayer:
         # 'b' : destination singlet selector
         # 'func' : sympy expression in terms of singlet selectors describing
 
+        # GraphLayer selectors already converted from SysLayer selectors, by SysLayer selector name. Relationships share
+        # their endpoints, so most conversions during compose are repeats.
+        self._graph_selectors = {}
+
     def add_compartment(self, name):
         self.compartments.append(name)
 
@@ -37,7 +43,8 @@ class SysLayer:
         e['type'] = kind
         e['name'] = name
         e['compartment'] = compartment
-        e['states'] = states
+        # Elements without states always store None, so compose only has to check for that.
+        e['states'] = states if states else None
         self.elements.append(e)
 
     def add_relationship(self, kind, a, b, function):
@@ -92,38 +99,35 @@ class SysLayer:
             pass
 
     def convert_sys_sel_to_graph(self, graph, selector, state_override=None):
+        if state_override is None and selector.name in self._graph_selectors:
+            return self._graph_selectors[selector.name]
+
         cs = selector.selector
         sys_sel_type = cs['type'] # 'element' or 'element_state'
         if state_override is not None:
-            cs['target_state'] = state_override # store the overriden state
+            # Override on a copy; the selector itself (and its cached conversion) must not change.
+            cs = dict(cs, target_state=state_override)
 
         # syslayer selector types: 'element' and 'element_state'
         # graphlayer selector type: 'node'
 
         if sys_sel_type == 'element':  # selecting an element without a state
             sel = graph.get_node(type=cs['target_type'], name=cs['target_name'], compartment=cs['target_compartment'])
-            return sel
         elif sys_sel_type == 'element_state': # selecting a state of an element
             sel = graph.get_node(type=cs['target_type'], name=cs['target_name'], compartment=cs['target_compartment'], state=cs['target_state'])
-            return sel
         else:
             warn('SysLayer was unable to convert selector type %s to graph' % sys_sel_type)
+            return
+
+        if state_override is None:
+            self._graph_selectors[selector.name] = sel
+        return sel
 
     def convert_sys_func_to_graph(self, graph, func):
-        for arg in func.args:
-            if isinstance(arg, Selector):
-                # term is a syslayer selector, convert to a graphlayer selector
-                graph_selector = self.convert_sys_sel_to_graph(graph, arg)
-                func = func.subs(arg, graph_selector)
-            elif isinstance(arg, Constant):
-                # term is a constant, don't change it
-                sys_constant = arg
-                func = func.subs(arg, sys_constant)
-            else:
-                # term is a composite, recurse
-                result = self.convert_sys_func_to_graph(graph, arg)
-                func = func.subs(arg, result)
-        return func
+        # Convert each syslayer selector in func to a graphlayer selector and swap them all in with one xreplace, rather
+        # than a subs (which rebuilds the tree) per term. Constants are left alone.
+        mapping = {arg: self.convert_sys_sel_to_graph(graph, arg) for arg in func.atoms(Selector)}
+        return func.xreplace(mapping)
 
     def gen_states_for_tx_cell(self, tx_cell):
         state_names = tx_cell['states']
@@ -133,29 +137,33 @@ class SysLayer:
         # for each state, iterate through the other states
         n = len(state_names)
         out = []
-        # Iterate through all possible states of n binary vars
+        # Iterate through all possible states of n binary vars; the value of state j is bit j of i, counting from the
+        # most significant of n bits.
         for i in range(1 << n):
-            s = bin(i)[2:]
-            s = '0' * (n - len(s)) + s
-            state = list(map(int, list(s)))
-            state_description = [(state_names[j], state[j]) for j in range(n)]
-            out.append(state_description)
+            out.append([(state_names[j], (i >> (n - 1 - j)) & 1) for j in range(n)])
         return out
 
     def compose(self):
         # Generate a graph layer from this systems layer
         graph = graphlayer.GraphLayer()
+        self._graph_selectors = {}
 
         # CREATE ALL THE NODES
+        # Collect a record for each node (one per state for elements with states) and add them to the graph together.
+        nodes = []
+        # A tx cell is an element in every compartment with the same states, so generate each set of states only once.
+        states_for = {}
         for element in self.elements:
             # If the element has states, iterate through the states
-            if 'states' in element:
-                if isinstance(element['states'], list):
-                    if len(element['states']) > 0:
-                        for state in self.gen_states_for_tx_cell(element):
-                            graph.add_node(type=element['type'], name=element['name'], compartment=element['compartment'], state=state)
-                        continue
-            graph.add_node(type=element['type'], name=element['name'], compartment=element['compartment'])
+            if element['states'] is not None:
+                key = tuple(element['states'])
+                if key not in states_for:
+                    states_for[key] = self.gen_states_for_tx_cell(element)
+                nodes.extend((element['type'], element['name'], element['compartment'], state)
+                             for state in states_for[key])
+                continue
+            nodes.append((element['type'], element['name'], element['compartment'], None))
+        graph.add_nodes(nodes)
 
         # CREATE ALL THE EDGES
         # * proliferation (intra-state)
@@ -164,12 +172,20 @@ class SysLayer:
         # * circuitry (trans-state, intra-compartment)
         # * relationship (generic; depends on selectors)
 
+        # Relationships often share a func (e.g. the same rate term on several edges), and a func always converts the
+        # same way within a compose, so convert each distinct func once.
+        graph_funcs = {}
+        add_edge = graph.add_edge
+        convert_sel = self.convert_sys_sel_to_graph
+        convert_func = self.convert_sys_func_to_graph
         for relationship in self.relationships:
-            a = self.convert_sys_sel_to_graph(graph, relationship['a'])
-            b = self.convert_sys_sel_to_graph(graph, relationship['b'])
-            func = self.convert_sys_func_to_graph(graph, relationship['func'])
+            a = convert_sel(graph, relationship['a'])
+            b = convert_sel(graph, relationship['b'])
+            func = graph_funcs.get(relationship['func'])
+            if func is None:
+                func = graph_funcs[relationship['func']] = convert_func(graph, relationship['func'])
 
-            graph.add_edge(type=relationship['type'], a=a, b=b, func=func)
+            add_edge(type=relationship['type'], a=a, b=b, func=func)
 
         return graph
 
@@ -8,17 +8,13 @@ import math
 
 
 def format_timedelta(diff):
-    if isinstance(diff, numbers.Real):
-        s = diff
-        d = 0
-    else:
-        s = diff.seconds
-        d = diff.days
-    h,r = divmod(s, 3600)
-    m,s = divmod(r, 60)
+    # diff is either a number of seconds or a datetime.timedelta.
+    s = diff if isinstance(diff, numbers.Real) else diff.days * 86400 + diff.seconds
+    d, r = divmod(int(s), 86400)
+    h, r = divmod(r, 3600)
+    m, s = divmod(r, 60)
     if d > 0:
-        return '%02d:%02d:%02d:%02ds' % (diff.days, h,m,s)
-    else:
-        return '%02d:%02d:%02ds' % (h,m,s)
+        return '%02d:%02d:%02d:%02ds' % (d, h, m, s)
+    return '%02d:%02d:%02ds' % (h, m, s)
 
 
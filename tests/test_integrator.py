@@ -0,0 +1,138 @@
+# Copyright 2020 Hersh K. Bhargava (https://hershbhargava.com)
+# Laboratories of Hana El-Samad and Wendell A. Lim
+# University of California, San Francisco
+
+"""
+Check the compiled integrators in `celltx.odelayer.integrator` against `scipy.integrate.odeint`.
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+import sympy as sy
+from numba import njit
+from scipy.integrate import odeint
+
+from celltx.functions import Selector, Constant
+from celltx.odelayer import odelayer
+from celltx.odelayer.integrator import rk4, rk4_ensemble, dopri5, dopri5_ensemble
+
+
+@njit
+def f_linear(X, t, args):
+    # dX/dt = -k * X, dY/dt = k * X - Y
+    out = np.empty(2)
+    out[0] = -args[0] * X[0]
+    out[1] = args[0] * X[0] - X[1]
+    return out
+
+
+def reference(x0, t, args):
+    return odeint(f_linear, x0, t, args=(args,), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('t', [np.linspace(0, 5, 21), np.linspace(5, 0, 21)], ids=['forward', 'backward'])
+def test_rk4_matches_odeint(t):
+    x0 = np.array([1.0, 0.5])
+    args = np.array([0.7])
+    np.testing.assert_allclose(rk4(f_linear, x0, t, args, 10), reference(x0, t, args), rtol=1e-6, atol=1e-8)
+
+
+@pytest.mark.parametrize('t', [np.linspace(0, 5, 21), np.linspace(5, 0, 21)], ids=['forward', 'backward'])
+def test_dopri5_matches_odeint(t):
+    x0 = np.array([1.0, 0.5])
+    args = np.array([0.7])
+    X, success = dopri5(f_linear, x0, t, args, 1e-10, 1e-10, 100000)
+    assert success
+    np.testing.assert_allclose(X, reference(x0, t, args), rtol=1e-7, atol=1e-9)
+
+
+def test_dopri5_rejects_non_monotonic_t():
+    X, success = dopri5(f_linear, np.array([1.0, 0.5]), np.array([0.0, 2.0, 1.0]), np.array([0.7]), 1e-8, 1e-8,
+                        100000)
+    assert not success
+    assert np.isnan(X[1:]).all()
+
+
+def test_ensembles_match_odeint():
+    t = np.linspace(0, 5, 21)
+    x0s = np.array([[1.0, 0.5], [2.0, 0.0], [0.5, 1.0]])
+    args_sets = np.array([[0.7], [0.2], [1.5]])
+    expected = np.array([reference(x0, t, args) for x0, args in zip(x0s, args_sets)])
+
+    np.testing.assert_allclose(rk4_ensemble(f_linear, x0s, t, args_sets, 10), expected, rtol=1e-6, atol=1e-8)
+
+    Xs, success = dopri5_ensemble(f_linear, x0s, t, args_sets, 1e-10, 1e-10, 100000)
+    assert success.all()
+    np.testing.assert_allclose(Xs, expected, rtol=1e-7, atol=1e-9)
+
+
+@pytest.fixture
+def stiff_layer(tmp_path, monkeypatch):
+    """ODELayer for dX/dt = -k * (X - Y), dY/dt = -Y, which is stiff for large k."""
+    monkeypatch.setattr(odelayer, 'CACHE_DIR', str(tmp_path))
+    t = sy.Symbol('t')
+    X = Selector('X', 'species', 'X')
+    Y = Selector('Y', 'species', 'Y')
+    k = Constant('k', 1e5)
+    layer = odelayer.ODELayer([sy.Eq(sy.Derivative(X, t), -k * (X - Y)), sy.Eq(sy.Derivative(Y, t), -Y)])
+    layer.gen_ode_model()
+    layer.x0[:] = [1.0, 1.0]
+    layer.backend = 'dopri5'
+    layer.dopri5_max_steps = 1000
+    return layer
+
+
+def test_stiff_dopri5_falls_back_to_odeint(stiff_layer):
+    t = np.linspace(0, 10, 11)
+    X, success = dopri5(stiff_layer.f_rhs, stiff_layer.x0, t, stiff_layer._param_values, stiff_layer.rtol,
+                        stiff_layer.atol, stiff_layer.dopri5_max_steps)
+    assert not success
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        X = stiff_layer.integrate(t)
+    assert any('falling back to odeint' in str(w.message) for w in caught)
+    np.testing.assert_allclose(X[:, 1], np.exp(-t), rtol=1e-4, atol=1e-7)
+    np.testing.assert_allclose(X[:, 0], np.exp(-t), rtol=1e-4, atol=1e-7)
+
+
+def test_stiff_dopri5_ensemble_falls_back_to_odeint(stiff_layer):
+    t = np.linspace(0, 10, 11)
+    x0s = np.tile(stiff_layer.x0, (3, 1))
+    param_sets = np.array([[1e5], [2.0], [1e5]])
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        Xs = stiff_layer.solve_ensemble(x0s, t, param_sets, 1)
+    assert any('falling back' in str(w.message) for w in caught)
+
+    stiff_layer.backend = 'odeint'
+    for X, x0, params in zip(Xs, x0s, param_sets):
+        np.testing.assert_allclose(X, stiff_layer.solve(x0, t, params), rtol=1e-4, atol=1e-7)
+
+
+def test_stiff_rk4_falls_back_to_odeint(stiff_layer):
+    t = np.linspace(0, 10, 11)
+    assert not np.isfinite(rk4(stiff_layer.f_rhs, stiff_layer.x0, t, stiff_layer._param_values, 10)).all()
+
+    stiff_layer.backend = 'rk4'
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        X = stiff_layer.integrate(t)
+        Xs = stiff_layer.solve_ensemble(np.tile(stiff_layer.x0, (2, 1)), t, np.array([[1e5], [2.0]]), 1)
+    assert sum('falling back to odeint' in str(w.message) for w in caught) == 2
+
+    stiff_layer.backend = 'odeint'
+    np.testing.assert_allclose(X, stiff_layer.integrate(t), rtol=1e-4, atol=1e-7)
+    for X, params in zip(Xs, [[1e5], [2.0]]):
+        np.testing.assert_allclose(X, stiff_layer.solve(stiff_layer.x0, t, params), rtol=1e-4, atol=1e-7)
+
+
+def test_dopri5_detects_stiffness(stiff_layer):
+    # With enough steps dopri5 could crawl through the stiff model, but it gives up as soon as it detects stiffness.
+    t = np.linspace(0, 10, 11)
+    X, success = dopri5(stiff_layer.f_rhs, stiff_layer.x0, t, stiff_layer._param_values, stiff_layer.rtol,
+                        stiff_layer.atol, 10 ** 8)
+    assert not success
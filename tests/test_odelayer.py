@@ -0,0 +1,200 @@
+# Copyright 2020 Hersh K. Bhargava (https://hershbhargava.com)
+# Laboratories of Hana El-Samad and Wendell A. Lim
+# University of California, San Francisco
+
+"""
+Tests of `celltx.odelayer.ODELayer` on small hand written models.
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+import sympy as sy
+
+from celltx.functions import Selector, Constant
+from celltx.odelayer import odelayer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def decay_layer():
+    """ODELayer for dX/dt = -k * X, dY/dt = k * X - Y, starting from X = 1, Y = 0."""
+    t = sy.Symbol('t')
+    X = Selector('X', 'species', 'X')
+    Y = Selector('Y', 'species', 'Y')
+    k = Constant('k', 0.5)
+    layer = odelayer.ODELayer([sy.Eq(sy.Derivative(X, t), -k * X), sy.Eq(sy.Derivative(Y, t), k * X - Y)])
+    layer.gen_ode_model()
+    layer.x0[:] = [1.0, 0.0]
+    return layer
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Point the model cache at a temporary directory."""
+    monkeypatch.setattr(odelayer, 'CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize('backend', ['rk4', 'dopri5'])
+def test_process_exits_after_ensemble_and_pool(backend, tmp_path):
+    # Forking a pool once numba's threads are running used to leave the process hanging at exit.
+    script = textwrap.dedent("""
+        import sys
+        sys.path.insert(0, %r)
+        import numpy as np
+        sys.path.insert(0, %r)
+        from test_odelayer import decay_layer
+
+        layer = decay_layer()
+        layer.backend = %r
+        layer.set_param_search_range('k', [0.1, 1.0])
+        t = np.linspace(0, 1, 5)
+        layer.execute_paramspace_search(t, 8, 1)
+        layer.execute_paramspace_search(t, 8, 2, quash_species=[(0,)])
+        """) % (ROOT, os.path.dirname(os.path.abspath(__file__)), backend)
+    env = dict(os.environ, CELLTX_CACHE_DIR=str(tmp_path))
+    env.pop('NUMBA_THREADING_LAYER', None)
+    result = subprocess.run([sys.executable, '-c', script], env=env, timeout=120, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    assert result.returncode == 0, result.stderr.decode()
+
+
+def test_solve_stacked_matches_solve(cache_dir):
+    layer = decay_layer()
+    t = np.linspace(0, 10, 21)
+    x0s = np.array([[1.0, 0.0], [2.0, 0.5], [0.5, 1.0], [3.0, 0.0]])
+    param_sets = np.array([[0.5], [0.1], [2.0], [1.0]])
+
+    Xs = layer.solve_stacked(x0s, t, param_sets)
+    assert len(Xs) == len(x0s)
+    for X, x0, params in zip(Xs, x0s, param_sets):
+        np.testing.assert_allclose(X, layer.solve(x0, t, params), rtol=1e-5, atol=1e-7)
+
+
+def test_solve_stacked_isolates_failing_simulation(cache_dir):
+    t = sy.Symbol('t')
+    X = Selector('X', 'species', 'X')
+    k = Constant('k', 0.5)
+    # Dividing by k raises for k = 0, in the stacked call as well as on its own.
+    layer = odelayer.ODELayer([sy.Eq(sy.Derivative(X, t), -X / k)])
+    layer.gen_ode_model()
+    t = np.linspace(0, 1, 5)
+    x0s = np.ones((4, 1))
+    param_sets = np.array([[0.5], [1.0], [0.0], [2.0]])
+
+    with pytest.warns(UserWarning, match='Stacked odeint failed'):
+        Xs = layer.solve_stacked(x0s, t, param_sets)
+    assert isinstance(Xs[2], ZeroDivisionError)
+    for i in [0, 1, 3]:
+        np.testing.assert_allclose(Xs[i][:, 0], np.exp(-t / param_sets[i, 0]), rtol=1e-6)
+
+
+def bloom_layer():
+    """
+    ODELayer for dX/dt = X * (Y - k), dY/dt = c, dW/dt = c * W, starting from X = 100, Y = 0, W = 5. With k = 3 and
+    c = 0.5, X falls below 1 at t ~ 1.8, bottoms out around 0.01 at t = 6 and grows back to 100 by t = 12.
+    """
+    t = sy.Symbol('t')
+    X = Selector('X', 'species', 'X')
+    Y = Selector('Y', 'species', 'Y')
+    W = Selector('W', 'species', 'W')
+    k = Constant('k', 3.0)
+    c = Constant('c', 0.5)
+    layer = odelayer.ODELayer([sy.Eq(sy.Derivative(X, t), X * (Y - k)), sy.Eq(sy.Derivative(Y, t), c),
+                               sy.Eq(sy.Derivative(W, t), c * W)])
+    layer.gen_ode_model()
+    for name, value in [('X', 100.0), ('Y', 0.0), ('W', 5.0)]:
+        layer.set_initial_value_byname(name, value)
+    return layer
+
+
+def test_integrate_quash_species(cache_dir):
+    layer = bloom_layer()
+    x, y, w = [layer.index_of_species(name) for name in ['X', 'Y', 'W']]
+    others = [y, w]
+    t = np.linspace(0, 12, 49)
+    X = layer.integrate(t)
+    # Without quashing, X recovers.
+    assert X[:, x].min() < 1
+    np.testing.assert_allclose(X[-1, x], 100.0, rtol=1e-4)
+
+    # X first falls below 1 at t = 2 (index 8), so it is set to 0 at the timepoint before and stays there. The
+    # timepoints before are unchanged. The rest of `t` is integrated from the quashed state at index 7, but starting
+    # at t[8], so the other species hold their value for one timepoint and then continue shifted by one.
+    Q = layer.integrate_quash_species(t, [(x,)])
+    np.testing.assert_allclose(Q[:7], X[:7])
+    assert (Q[7:, x] == 0).all()
+    np.testing.assert_allclose(Q[7:, others], X[np.r_[7, 7:len(t) - 1]][:, others], rtol=1e-6)
+
+    # A single group doesn't need to be in a list.
+    np.testing.assert_allclose(layer.integrate_quash_species(t, (x,)), Q)
+
+    # W never falls below 1, so a group of X and W is never quashed.
+    np.testing.assert_allclose(layer.integrate_quash_species(t, [(x, w)]), X)
+
+    # Y is below 1 until t = 2, when X first is, so X and Y are never below 1 at the same timepoint.
+    np.testing.assert_allclose(layer.integrate_quash_species(t, [(x, y)]), X)
+
+    # Once X is quashed, the group of X and Y is below 1 wherever Y is, so both are set to 0 at index 6.
+    Q = layer.integrate_quash_species(t, [(x,), (x, y)])
+    assert (Q[7:, x] == 0).all() and (Q[6, [x, y]] == 0).all()
+    np.testing.assert_allclose(Q[:6], X[:6])
+
+
+def test_model_cache_miss_and_hit(cache_dir, monkeypatch):
+    t = np.linspace(0, 5, 11)
+    X = decay_layer().integrate(t)
+    sources = list(cache_dir.glob('celltx_model_*.py'))
+    assert len(sources) == 1
+
+    # The same equations load the cached module without generating it again.
+    def fail(*args):
+        raise AssertionError('the model source was generated again')
+    monkeypatch.setattr(odelayer.ODELayer, 'gen_model_source', fail)
+    np.testing.assert_allclose(decay_layer().integrate(t), X)
+    assert list(cache_dir.glob('celltx_model_*.py')) == sources
+
+
+def test_model_cache_invalidated_by_codegen_hash(cache_dir, monkeypatch):
+    t = np.linspace(0, 5, 11)
+    X = decay_layer().integrate(t)
+    monkeypatch.setattr(odelayer, '_CODEGEN_HASH', 'changed')
+    np.testing.assert_allclose(decay_layer().integrate(t), X)
+    assert len(list(cache_dir.glob('celltx_model_*.py'))) == 2
+
+
+def test_model_cache_unwritable(tmp_path, monkeypatch):
+    # A directory can't be created under a file, whatever the permissions.
+    (tmp_path / 'file').write_text('')
+    monkeypatch.setattr(odelayer, 'CACHE_DIR', str(tmp_path / 'file' / 'cache'))
+    with pytest.warns(UserWarning, match='Unable to write to the model cache'):
+        layer = decay_layer()
+    t = np.linspace(0, 5, 11)
+    np.testing.assert_allclose(layer.integrate(t)[:, 0], np.exp(-0.5 * t), rtol=1e-6)
+
+
+def test_cache_dir_from_environment(tmp_path):
+    env = dict(os.environ, CELLTX_CACHE_DIR=str(tmp_path))
+    output = subprocess.check_output([sys.executable, '-c', 'from celltx.odelayer import odelayer; '
+                                                           'print(odelayer.CACHE_DIR)'], env=env, cwd=ROOT)
+    assert output.decode().strip() == str(tmp_path)
+
+
+def test_search_range_of_unknown_parameter(cache_dir):
+    t = sy.Symbol('t')
+    X = Selector('X', 'species', 'X')
+    k = Constant('k', 0.5)
+    layer = odelayer.ODELayer([sy.Eq(sy.Derivative(X, t), -k * X)])
+    layer.set_param_search_range('k', [0.1, 1.0])
+    layer.set_param_search_range('removed', [1.0, 2.0])
+    with pytest.warns(UserWarning, match='removed'):
+        layer.gen_ode_model()
+
+    samples = layer.gen_paramspace_samples(10)
+    assert samples.shape == (10, 1)
+    assert ((samples >= 0.1) & (samples <= 1.0)).all()